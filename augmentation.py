@@ -0,0 +1,160 @@
+import torch
+
+# Batched augmentation on device, used by Model_Instance(batch_transform=...)
+# data is a (N,C,H,W) tensor, label can be a (N,H,W)/(N,C,H,W) mask which get the same
+# geometric transform (flip/crop), other labels are returned untouched.
+# Random transforms only run in training mode (Model_Instance call train(update)).
+
+def _expand(mask,tensor):
+    # (N,) -> (N,1,1,...) broadcast to tensor
+    return mask.view(-1,*([1]*(tensor.dim()-1)))
+
+def _is_mask(data,label):
+    return torch.is_tensor(label) and label.dim() >= 3 and label.shape[0] == data.shape[0] and label.shape[-2:] == data.shape[-2:]
+
+class BatchTransform():
+    random=True
+
+    def __init__(self,p=0.5):
+        self.p=p
+        self.training=True
+
+    def train(self,mode=True):
+        self.training=mode
+        return self
+
+    def sample(self,data):
+        return torch.rand(data.shape[0],device=data.device) < self.p
+
+    def apply(self,data,label):
+        raise NotImplementedError
+
+    def __call__(self,data,label=None):
+        if self.random and not self.training:
+            return data,label
+        return self.apply(data,label)
+
+class Compose(BatchTransform):
+    random=False
+
+    def __init__(self,transforms):
+        super().__init__()
+        self.transforms=transforms
+
+    def train(self,mode=True):
+        self.training=mode
+        for t in self.transforms:
+            t.train(mode)
+        return self
+
+    def apply(self,data,label):
+        for t in self.transforms:
+            data,label = t(data,label)
+        return data,label
+
+class ToTensor(BatchTransform):
+    '''
+    uint8 (N,H,W,C) images from dataset -> float (N,C,H,W) / scale, masks (N,H,W) are kept.
+    '''
+    random=False
+
+    def __init__(self,scale=255.,channels_last=True):
+        super().__init__()
+        self.scale=scale
+        self.channels_last=channels_last
+
+    def apply(self,data,label):
+        if self.channels_last:
+            data = data.permute(0,3,1,2)
+            if torch.is_tensor(label) and label.dim() == 4 and label.shape[1:3] == data.shape[-2:]:
+                label = label.permute(0,3,1,2)
+        data = data.float()
+        if self.scale:
+            data = data/self.scale
+        return data.contiguous(),label
+
+class HorizontalFlip(BatchTransform):
+    def apply(self,data,label):
+        flip = self.sample(data)
+        data = torch.where(_expand(flip,data),data.flip(-1),data)
+        if _is_mask(data,label):
+            label = torch.where(_expand(flip,label),label.flip(-1),label)
+        return data,label
+
+class VerticalFlip(BatchTransform):
+    def apply(self,data,label):
+        flip = self.sample(data)
+        data = torch.where(_expand(flip,data),data.flip(-2),data)
+        if _is_mask(data,label):
+            label = torch.where(_expand(flip,label),label.flip(-2),label)
+        return data,label
+
+class RandomCrop(BatchTransform):
+    '''
+    Crop every sample at its own random position, size=(height,width). Always applied (p=1).
+    '''
+    def __init__(self,size):
+        super().__init__(p=1.)
+        self.size=size
+
+    def _crop(self,tensor,rows,cols):
+        n = torch.arange(tensor.shape[0],device=tensor.device)[:,None,None]
+        if tensor.dim() == 3:
+            return tensor[n,rows[:,:,None],cols[:,None,:]]
+        # (N,h,w,C) -> (N,C,h,w)
+        return tensor.permute(0,2,3,1)[n,rows[:,:,None],cols[:,None,:]].permute(0,3,1,2).contiguous()
+
+    def apply(self,data,label):
+        height,width = data.shape[-2:]
+        top = torch.randint(0,height-self.size[0]+1,(data.shape[0],),device=data.device)
+        left = torch.randint(0,width-self.size[1]+1,(data.shape[0],),device=data.device)
+        rows = top[:,None]+torch.arange(self.size[0],device=data.device)
+        cols = left[:,None]+torch.arange(self.size[1],device=data.device)
+        is_mask = _is_mask(data,label)
+        data = self._crop(data,rows,cols)
+        if is_mask:
+            label = self._crop(label,rows,cols)
+        return data,label
+
+class CenterCrop(RandomCrop):
+    random=False
+
+    def apply(self,data,label):
+        height,width = data.shape[-2:]
+        top,left = (height-self.size[0])//2,(width-self.size[1])//2
+        if _is_mask(data,label):
+            label = label[...,top:top+self.size[0],left:left+self.size[1]]
+        return data[...,top:top+self.size[0],left:left+self.size[1]],label
+
+class RandomBrightnessContrast(BatchTransform):
+    '''
+    x = (x-mean)*contrast+mean+brightness, factors sampled per image in
+    contrast 1+-contrast_limit and brightness +-brightness_limit*(max-min).
+    '''
+    def __init__(self,brightness_limit=0.2,contrast_limit=0.2,p=0.5):
+        super().__init__(p)
+        self.brightness_limit=brightness_limit
+        self.contrast_limit=contrast_limit
+
+    def apply(self,data,label):
+        n = data.shape[0]
+        apply = _expand(self.sample(data),data)
+        brightness = _expand((torch.rand(n,device=data.device)*2-1)*self.brightness_limit,data)
+        contrast = _expand(1+(torch.rand(n,device=data.device)*2-1)*self.contrast_limit,data)
+        mean = data.mean(dim=tuple(range(1,data.dim())),keepdim=True)
+        value_range = data.amax(dim=tuple(range(1,data.dim())),keepdim=True)-data.amin(dim=tuple(range(1,data.dim())),keepdim=True)
+        adjusted = (data-mean)*contrast+mean+brightness*value_range
+        return torch.where(apply,adjusted.to(data.dtype),data),label
+
+class Normalize(BatchTransform):
+    random=False
+
+    def __init__(self,mean=(0.5,0.5,0.5),std=(0.5,0.5,0.5)):
+        super().__init__()
+        self.mean=torch.tensor(mean).view(1,-1,1,1)
+        self.std=torch.tensor(std).view(1,-1,1,1)
+
+    def apply(self,data,label):
+        if self.mean.device != data.device:
+            self.mean,self.std = self.mean.to(data.device),self.std.to(data.device)
+        return (data-self.mean.to(data.dtype))/self.std.to(data.dtype),label
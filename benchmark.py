@@ -0,0 +1,273 @@
+import torch
+import torch.nn as nn
+from torch.utils.data import TensorDataset,DataLoader
+import numpy as np
+import time
+import sys
+import os
+import tempfile
+
+from model_instance import Model_Instance
+
+
+def get_toy_dataloader(n_samples=4096,n_features=64,n_classes=4,batch_size=32):
+    data = torch.randn(n_samples,n_features)
+    labels = torch.randint(0,n_classes,(n_samples,))
+    return DataLoader(TensorDataset(data,labels),batch_size=batch_size,shuffle=False)
+
+def get_toy_model(n_features=64,n_classes=4):
+    return nn.Sequential(nn.Linear(n_features,256),nn.ReLU(),nn.Linear(256,n_classes))
+
+def get_zoo_models():
+    from model_zoo.Unet_zoo import U_Net,R2U_Net,AttU_Net,R2AttU_Net
+    from model_zoo.model_family import HarDNet
+    return {'U_Net':lambda **kwargs: U_Net(img_ch=3,output_ch=1,**kwargs),
+            'R2U_Net':lambda **kwargs: R2U_Net(img_ch=3,output_ch=1,**kwargs),
+            'AttU_Net':lambda **kwargs: AttU_Net(img_ch=3,output_ch=1,**kwargs),
+            'R2AttU_Net':lambda **kwargs: R2AttU_Net(img_ch=3,output_ch=1,**kwargs),
+            'HarDNet39':lambda **kwargs: HarDNet(arch=39,pretrained=False,**kwargs)}
+
+def steps_per_sec(model_instance,dataloader,update=True,repeat=3):
+    # first epoch is warm up
+    model_instance.run_dataloader(dataloader,update=update)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        model_instance.run_dataloader(dataloader,update=update)
+    return repeat*len(dataloader)/(time.perf_counter()-start)
+
+def bench_sync(device=torch.device('cpu')):
+    # per-iteration sync (sync_interval=1) vs deferred sync
+    dataloader = get_toy_dataloader()
+    for sync_interval in [1,10,50]:
+        torch.manual_seed(0)
+        model = get_toy_model()
+        model_instance = Model_Instance(model=model,
+                                        optimizer=torch.optim.SGD(model.parameters(),lr=1e-2),
+                                        loss_function=nn.CrossEntropyLoss(),
+                                        evaluation_function=['acc'],
+                                        device=device,
+                                        sync_interval=sync_interval)
+        print(f'sync_interval={sync_interval:<3} {steps_per_sec(model_instance,dataloader):.1f} steps/sec')
+
+def bench_plot(n_experiments=100,n_epochs=1000):
+    # headless plot_experiments over n_experiments x n_epochs records
+    from logger import Logger
+    Logger.save_dir = tempfile.mkdtemp()
+    rng = np.random.default_rng(0)
+    for e in range(n_experiments):
+        Logger.init(f'experiment{e}',overwrite=True)
+        train_logger,valid_logger = Logger('Train'),Logger('Valid')
+        for _ in range(n_epochs):
+            train_logger(loss=rng.random(),acc=rng.random())
+            valid_logger(loss=rng.random(),acc=rng.random(),f1score=rng.random())
+    for max_points in [None,200]:
+        start = time.perf_counter()
+        Logger.plot_experiments(show=False,save=True,max_points=max_points)
+        print(f'max_points={str(max_points):<5} {time.perf_counter()-start:.2f} sec, {os.path.join(Logger.save_dir,"experiments_history.png")}')
+
+def bench_startup(n_layers=16,width=2048,repeat=3):
+    # time-to-first-batch: build instance, load checkpoint, first inference batch
+    save_dir = tempfile.mkdtemp()
+    get_model = lambda: nn.Sequential(*[nn.Linear(width,width) for _ in range(n_layers)])
+    torch.save(get_model().state_dict(),os.path.join(save_dir,'model_checkpoint.pkl'))
+    print(f'checkpoint {os.path.getsize(os.path.join(save_dir,"model_checkpoint.pkl"))/1024**2:.0f} MB')
+    dataloader = DataLoader(torch.randn(256,width),batch_size=32)
+
+    def full_read(model_instance):
+        state_dict = torch.load(os.path.join(save_dir,'model_checkpoint.pkl'),map_location='cpu')
+        model_instance.model.load_state_dict(state_dict)
+
+    for name,load in [('torch.load',full_read),('mmap',lambda model_instance: model_instance.load())]:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model_instance = Model_Instance(model=get_model(),save_dir=save_dir,device=torch.device('cpu'))
+            load(model_instance)
+            model_instance.inference(next(iter(dataloader)))
+            times.append(time.perf_counter()-start)
+        print(f'{name:<10} time to first batch {min(times):.3f} sec')
+
+def bench_compile(batch_size=2,image_size=64,repeat=5,compile_mode='inductor',models=None):
+    # eager vs compiled CPU inference throughput of model_zoo networks, warm up include compilation
+    # compile cache is kept in the temp dir, run it twice to see the cached warm up
+    save_dir = tempfile.mkdtemp()
+    cache_dir = os.path.join(tempfile.gettempdir(),'benchmark_compile_cache')
+    data = torch.randn(batch_size,3,image_size,image_size)
+    for name,get_model in get_zoo_models().items():
+        if models and name not in models:
+            continue
+        for mode in [None,compile_mode]:
+            torch.manual_seed(0)
+            model_instance = Model_Instance(model=get_model(),save_dir=save_dir,device=torch.device('cpu'),
+                                            compile_mode=mode,compile_cache_dir=cache_dir)
+            start = time.perf_counter()
+            model_instance.inference(data)
+            warm_up = time.perf_counter()-start
+            start = time.perf_counter()
+            for _ in range(repeat):
+                model_instance.inference(data)
+            print(f'{name:<11} {str(mode):<9} warm up {warm_up:6.2f} sec {repeat/(time.perf_counter()-start):6.2f} it/sec')
+
+def _zoo_worker(queue,name,batch_size,image_size,n_batches,amp=False,model_kwargs={},inference=True):
+    # train (and inference) steps/sec and peak memory of a model_zoo network on CPU
+    import resource
+    from utils import TransferPolicy
+    torch.manual_seed(0)
+    model = get_zoo_models()[name](**model_kwargs)
+    segmentation = name != 'HarDNet39'
+    data = torch.randn(batch_size*n_batches,3,image_size,image_size)
+    if segmentation:
+        labels = (torch.rand(batch_size*n_batches,1,image_size,image_size) > 0.5).float()
+    else:
+        labels = torch.randint(0,1000,(batch_size*n_batches,))
+    dataloader = DataLoader(TensorDataset(data,labels),batch_size=batch_size)
+    model_instance = Model_Instance(model=model,
+                                    optimizer=torch.optim.SGD(model.parameters(),lr=1e-3),
+                                    loss_function=nn.BCEWithLogitsLoss() if segmentation else nn.CrossEntropyLoss(),
+                                    device=torch.device('cpu'),
+                                    save_dir=tempfile.mkdtemp(),
+                                    amp=amp,
+                                    transfer_policy=TransferPolicy(label='float' if segmentation else torch.long))
+    result = {'train':steps_per_sec(model_instance,dataloader,update=True,repeat=1)}
+    if inference:
+        start = time.perf_counter()
+        model_instance.inferance_dataloader(DataLoader(data,batch_size=batch_size))
+        result['inference'] = n_batches/(time.perf_counter()-start)
+    # ru_maxrss is in KB on Linux
+    result['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    queue.put(result)
+
+def run_in_process(target,*args,**kwargs):
+    # every run in a new process so peak memory is not shared
+    import multiprocessing
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=target,args=(queue,*args),kwargs=kwargs)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def bench_precision(batch_size=4,image_size=64,n_batches=5,models=None):
+    # fp32 vs bf16 autocast on CPU
+    for name in get_zoo_models().keys():
+        if models and name not in models:
+            continue
+        for amp in [False,True]:
+            result = run_in_process(_zoo_worker,name,batch_size,image_size,n_batches,amp=amp)
+            train,inference,max_rss = result['train'],result['inference'],result['max_rss']
+            print(f'{name:<11} {"bf16" if amp else "fp32"} train {train:6.2f} steps/sec inference {inference:6.2f} it/sec peak memory {max_rss:7.1f} MB')
+
+def bench_checkpoint(batch_size=4,image_size=128,n_batches=3,models=['U_Net','R2U_Net']):
+    # activation checkpointing memory vs time, U_Net variants
+    settings = {'none':{},
+                'encoder':{'checkpoint_stages':['Conv1','Conv2','Conv3','RRCNN1','RRCNN2','RRCNN3']},
+                'all':{'checkpoint_stages':True}}
+    for name in models:
+        model_settings = dict(settings)
+        if name.startswith('R2'):
+            model_settings['all+recurrent'] = {'checkpoint_stages':True,'checkpoint_recurrent':True}
+        for setting,model_kwargs in model_settings.items():
+            result = run_in_process(_zoo_worker,name,batch_size,image_size,n_batches,model_kwargs=model_kwargs,inference=False)
+            print(f'{name:<11} {setting:<13} train {result["train"]:6.2f} steps/sec peak memory {result["max_rss"]:7.1f} MB')
+
+def legacy_hardblock_forward(self, x):
+    # HarDBlock.forward before the link graph/output buffer rewrite
+    layers_ = [x]
+    for layer in range(len(self.layers)):
+        tin = [layers_[i] for i in self.links[layer]]
+        x = torch.cat(tin, 1) if len(tin) > 1 else tin[0]
+        layers_.append(self.layers[layer](x))
+    t = len(layers_)
+    return torch.cat([layers_[i] for i in range(t) if (i == 0 and self.keepBase) or (i == t-1) or (i%2 == 1)], 1)
+
+def _hardnet_worker(queue,legacy,grad,batch_size,image_size,repeat):
+    import resource
+    from model_zoo.model_family import HarDNet,HarDBlock
+    if legacy:
+        HarDBlock.forward = legacy_hardblock_forward
+    torch.manual_seed(0)
+    model = HarDNet(arch=85,pretrained=False).train(grad)
+    data = torch.randn(batch_size,3,image_size,image_size)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        with torch.set_grad_enabled(grad):
+            out = model(data)
+            if grad:
+                out.sum().backward()
+    queue.put({'time':(time.perf_counter()-start)/repeat,'max_rss':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024})
+
+def profile_peak(fn):
+    # peak of live CPU tensor memory (MB) while fn run, process RSS hide allocator reuse
+    from torch.profiler import profile,ProfilerActivity
+    with profile(activities=[ProfilerActivity.CPU],profile_memory=True) as prof:
+        fn()
+    events = sorted([e for e in prof.events() if e.cpu_memory_usage and not e.cpu_children],key=lambda e: e.time_range.start)
+    current = peak = 0
+    for e in events:
+        current += e.cpu_memory_usage
+        peak = max(peak,current)
+    return peak/1024**2
+
+def bench_hardnet(batch_size=8,image_size=224,repeat=3):
+    # HarDNet85 HarDBlock forward, legacy concat vs link graph with early free/output buffer
+    from model_zoo.model_family import HarDBlock
+    torch.manual_seed(0)
+    block = HarDBlock(96,24,1.7,16).eval()
+    data = torch.randn(batch_size,96,image_size//4,image_size//4)
+    for legacy in [True,False]:
+        forward = (lambda: legacy_hardblock_forward(block,data)) if legacy else (lambda: block(data))
+        with torch.no_grad():
+            forward()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                forward()
+            elapsed = (time.perf_counter()-start)/repeat
+            peak = profile_peak(forward)
+        print(f'HarDBlock {"legacy" if legacy else "current":<8} no_grad {elapsed:6.3f} sec/batch peak tensor memory {peak:7.1f} MB')
+    for grad in [False,True]:
+        for legacy in [True,False]:
+            result = run_in_process(_hardnet_worker,legacy,grad,batch_size,image_size,repeat)
+            print(f'{"legacy" if legacy else "current":<8} {"train" if grad else "no_grad":<8} {result["time"]:6.3f} sec/batch peak memory {result["max_rss"]:7.1f} MB')
+
+def latency(model,data,repeat=10):
+    # ms per batch, first 2 calls are warm up (profiling executor optimize frozen graphs on the second one)
+    with torch.no_grad():
+        for _ in range(2):
+            model(data)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            model(data)
+    return (time.perf_counter()-start)/repeat*1000
+
+def bench_inference(batch_size=1,image_size=128,repeat=10,models=None):
+    # CPU latency of eager vs Conv+BN fused vs frozen TorchScript, outputs checked against eager
+    from model_zoo.optimize import optimize_for_inference,check_equivalence,to_memory_format
+    for name,get_model in get_zoo_models().items():
+        if models and name not in models:
+            continue
+        torch.manual_seed(0)
+        model = get_model().eval()
+        data = torch.randn(batch_size,3,image_size,image_size)
+        settings = {'eager':(model,data),
+                    'fused':(optimize_for_inference(model,data,channels_last=False,freeze=False),data),
+                    'fused+cl':(optimize_for_inference(model,data,freeze=False),to_memory_format(data)),
+                    'frozen':(optimize_for_inference(model,data),to_memory_format(data))}
+        for setting,(optimized,optimized_data) in settings.items():
+            diff = check_equivalence(model,optimized,data,channels_last=optimized_data is not data)
+            print(f'{name:<11} {setting:<9} {latency(optimized,optimized_data,repeat):8.2f} ms/batch max abs diff {diff:.1e}')
+
+benchmarks={'sync':bench_sync,
+            'plot':bench_plot,
+            'startup':bench_startup,
+            'compile':bench_compile,
+            'precision':bench_precision,
+            'checkpoint':bench_checkpoint,
+            'hardnet':bench_hardnet,
+            'inference':bench_inference}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] if len(sys.argv)>1 else benchmarks.keys()
+    for name in names:
+        print(f'==== {name} ====')
+        benchmarks[name]()
@@ -0,0 +1,195 @@
+import torch
+import numpy as np
+import random
+import os
+import json
+import threading
+from queue import Queue
+from utils import map_tensors
+from distributed import is_main_process
+
+# Full training state checkpoints of a Model_Instance
+# model/optimizer/scheduler/GradScaler/run_iter, Logger positions and RNG states.
+# Checkpointer snapshot the state to CPU in the training loop and serialize it on a background
+# thread, files are written to <name>.tmp then renamed so a crash never leaves a broken checkpoint.
+
+def snapshot(state):
+    # detached CPU copy of every tensor, training can keep updating the originals
+    return map_tensors(state, lambda t: t.detach().to(torch.device('cpu'),copy=True))
+
+def get_rng_state():
+    state={'python':random.getstate(),
+           'numpy':np.random.get_state(),
+           'torch':torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda']=torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+def training_state(model_instance,loggers=[],**extra):
+    state={'model':model_instance.model.state_dict(),
+           'optimizer':model_instance.optimizer.state_dict() if model_instance.optimizer else None,
+           'scheduler':model_instance.scheduler.state_dict() if model_instance.scheduler else None,
+           'grad_scaler':model_instance.grad_scaler.state_dict(),
+           'run_iter':model_instance.run_iter,
+           'loggers':{logger.tag:logger.state_dict() for logger in loggers},
+           'rng':get_rng_state(),
+           'extra':extra}
+    return snapshot(state)
+
+def load_file(path,device=torch.device('cpu'),mmap=True,weights_only=True):
+    # mmap=True map the file instead of reading it into memory, tensors are materialized
+    # on device directly. Checkpoints written by old torch (not zip format) fall back to a full read.
+    try:
+        return torch.load(path,map_location=device,mmap=mmap,weights_only=weights_only)
+    except RuntimeError as e:
+        if not mmap or 'zip' not in str(e):
+            raise
+        return torch.load(path,map_location=device,weights_only=weights_only)
+
+def load_model_state(model,state_dict,strict=True,verbose=True):
+    '''
+    strict=False load every matching key and skip missing/unexpected/shape mismatched ones.
+    Return {'missing':[...],'unexpected':[...],'mismatched':[...]}.
+    '''
+    model_state=model.state_dict()
+    mismatched=[k for k,v in state_dict.items() if k in model_state and torch.is_tensor(v) and v.shape != model_state[k].shape]
+    if mismatched and strict:
+        raise RuntimeError(f'size mismatch for {mismatched}')
+    state_dict={k:v for k,v in state_dict.items() if k not in mismatched}
+    incompatible=model.load_state_dict(state_dict,strict=strict)
+    report={'missing':list(incompatible.missing_keys),
+            'unexpected':list(incompatible.unexpected_keys),
+            'mismatched':mismatched}
+    if verbose and any(report.values()):
+        print('\n'.join(f'{k} keys: {v}' for k,v in report.items() if v))
+    return report
+
+def load_training_state(model_instance,state,loggers=[],strict=True):
+    report=load_model_state(model_instance.model,state['model'],strict)
+    if model_instance.optimizer and state['optimizer']:
+        model_instance.optimizer.load_state_dict(state['optimizer'])
+    if model_instance.scheduler and state['scheduler']:
+        model_instance.scheduler.load_state_dict(state['scheduler'])
+    if state['grad_scaler']:
+        model_instance.grad_scaler.load_state_dict(state['grad_scaler'])
+    model_instance.run_iter=state['run_iter']
+    for logger in loggers:
+        if logger.tag in state['loggers']:
+            logger.load_state_dict(state['loggers'][logger.tag])
+    set_rng_state(state['rng'])
+    return {**state['extra'],'report':report}
+
+def atomic_save(obj,path):
+    torch.save(obj,path+'.tmp')
+    os.replace(path+'.tmp',path)
+
+class Checkpointer():
+    '''
+    Asynchronous full-state checkpoints with retention.
+    save(epoch,metric) snapshot the state and return immediately, a background thread write
+    save_dir/<prefix>-<epoch>.pt, keep the last keep_last files and the keep_best files with the
+    best metric (mode min/max). checkpoint_index.json record them for resume().
+    wait() block until every pending checkpoint is on disk.
+    '''
+    def __init__(self,model_instance,loggers=[],save_dir=None,prefix='checkpoint',keep_last=3,keep_best=1,mode='min',async_save=True):
+        if mode not in ['min','max']:
+            raise Exception(f'{mode} mode not support, use min or max.')
+        self.model_instance=model_instance
+        self.loggers=loggers
+        self.save_dir=save_dir if save_dir else model_instance.save_dir
+        self.prefix=prefix
+        self.keep_last=keep_last
+        self.keep_best=keep_best
+        self.mode=mode
+        self.async_save=async_save
+        self.index_path=os.path.join(self.save_dir,f'{prefix}_index.json')
+        self.index={'last':[],'best':[]}
+        if os.path.exists(self.index_path):
+            with open(self.index_path,'r') as f:
+                self.index=json.load(f)
+        # at most one snapshot waiting, training blocks if disk is slower than checkpoint frequency
+        self.queue=Queue(maxsize=1)
+        self.thread=None
+        self.error=None
+        os.makedirs(self.save_dir,exist_ok=True)
+
+    def _worker(self):
+        while True:
+            state,filename,metric=self.queue.get()
+            try:
+                if self.error is None:
+                    self._write(state,filename,metric)
+            except BaseException as e:
+                self.error=e
+            finally:
+                self.queue.task_done()
+
+    def _write(self,state,filename,metric):
+        atomic_save(state,os.path.join(self.save_dir,filename))
+        self.index['last']=[name for name in self.index['last'] if name != filename]+[filename]
+        if metric is not None and self.keep_best:
+            best=[entry for entry in self.index['best'] if entry[1] != filename]+[[float(metric),filename]]
+            best.sort(key=lambda entry: entry[0],reverse=self.mode == 'max')
+            self.index['best']=best
+        keep=set(self.index['last'][-self.keep_last:] if self.keep_last else self.index['last'][-1:])
+        keep|={name for _,name in self.index['best'][:self.keep_best]}
+        for name in set(self.index['last'])|{name for _,name in self.index['best']}:
+            if name not in keep and os.path.exists(os.path.join(self.save_dir,name)):
+                os.remove(os.path.join(self.save_dir,name))
+        self.index['last']=[name for name in self.index['last'] if name in keep]
+        self.index['best']=self.index['best'][:self.keep_best]
+        with open(self.index_path+'.tmp','w') as f:
+            f.write(json.dumps(self.index,indent=2))
+        os.replace(self.index_path+'.tmp',self.index_path)
+
+    def _check_error(self):
+        if self.error is not None:
+            error,self.error=self.error,None
+            raise error
+
+    def save(self,epoch,metric=None,**extra):
+        # only rank 0 write checkpoints in distributed mode
+        if not is_main_process():
+            return None
+        self._check_error()
+        state=training_state(self.model_instance,self.loggers,epoch=epoch,metric=metric,**extra)
+        filename='{}-{:05d}.pt'.format(self.prefix,epoch)
+        if not self.async_save:
+            self._write(state,filename,metric)
+            return filename
+        if self.thread is None:
+            self.thread=threading.Thread(target=self._worker,daemon=True)
+            self.thread.start()
+        self.queue.put((state,filename,metric))
+        return filename
+
+    def wait(self):
+        self.queue.join()
+        self._check_error()
+
+    def best_checkpoint(self):
+        self.wait()
+        return self.index['best'][0][1] if self.index['best'] else None
+
+    def last_checkpoint(self):
+        self.wait()
+        return self.index['last'][-1] if self.index['last'] else None
+
+    def load(self,filename=None,strict=True):
+        # restore the full state, return the extra dict given to save (epoch, metric ...) and the keys report
+        filename=filename if filename else self.last_checkpoint()
+        state=load_file(os.path.join(self.save_dir,filename),self.model_instance.device,weights_only=False)
+        return load_training_state(self.model_instance,state,self.loggers,strict)
+
+    def resume(self):
+        # next epoch to run, 0 when there is no checkpoint
+        if self.last_checkpoint() is None:
+            return 0
+        return self.load()['epoch']+1
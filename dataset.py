@@ -1,17 +1,109 @@
 import torch.nn as nn
-from  torch.utils.data import Dataset,DataLoader
+from  torch.utils.data import Dataset,DataLoader,Sampler
 import torch
+import numpy as np
 import cv2
+import os
+from collections import OrderedDict
+
+def decode_image(path,image_size=None,interpolation=cv2.INTER_LINEAR):
+    image=cv2.imread(path)
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    if image_size:
+        # image_size=(height,width)
+        image = cv2.resize(image,(image_size[1],image_size[0]),interpolation=interpolation)
+    return image
+
+class ImageCache():
+    '''
+    Decoded RGB image cache keyed by path.
+    - in-memory LRU limited by max_bytes (per process)
+    - optional disk cache, build(paths) decode every image once into cache_path.bin (uint8)
+      with cache_path.index.npz, every DataLoader worker memory-map the same file.
+    image_size=(height,width) pre-resize images before caching, use cv2.INTER_NEAREST for masks.
+    '''
+    def __init__(self,max_bytes=2*1024**3,cache_path=None,image_size=None,interpolation=cv2.INTER_LINEAR):
+        self.max_bytes=max_bytes
+        self.cache_path=cache_path
+        self.image_size=image_size
+        self.interpolation=interpolation
+        self.memory=OrderedDict()
+        self.memory_bytes=0
+        self.index=None
+        self.data=None
+        if cache_path and os.path.exists(cache_path+'.index.npz'):
+            self._load_index()
+
+    def __getstate__(self):
+        # workers reopen the memory map and start with an empty LRU
+        state=self.__dict__.copy()
+        state['memory']=OrderedDict()
+        state['memory_bytes']=0
+        state['data']=None
+        return state
+
+    def _load_index(self):
+        index=np.load(self.cache_path+'.index.npz')
+        self.index={p:i for i,p in enumerate(index['paths'])}
+        self.offsets=index['offsets']
+        self.shapes=index['shapes']
+
+    def decode(self,path):
+        return decode_image(path,self.image_size,self.interpolation)
+
+    def build(self,paths,overwrite=False):
+        if not self.cache_path:
+            raise Exception('ImageCache need cache_path to build disk cache.')
+        if self.index is not None and not overwrite and set(paths).issubset(self.index.keys()):
+            return self
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)),exist_ok=True)
+        paths=list(dict.fromkeys(paths))
+        offsets=np.zeros(len(paths)+1,dtype=np.int64)
+        shapes=np.zeros((len(paths),3),dtype=np.int64)
+        with open(self.cache_path+'.bin.tmp','wb') as f:
+            for i,path in enumerate(paths):
+                image=np.ascontiguousarray(self.decode(path),dtype=np.uint8)
+                image=image.reshape(image.shape[0],image.shape[1],-1)
+                f.write(image.tobytes())
+                shapes[i]=image.shape
+                offsets[i+1]=offsets[i]+image.nbytes
+        os.replace(self.cache_path+'.bin.tmp',self.cache_path+'.bin')
+        np.savez(self.cache_path+'.index.npz',paths=np.array(paths),offsets=offsets,shapes=shapes)
+        self.data=None
+        self._load_index()
+        return self
+
+    def _read_disk(self,path):
+        if self.data is None:
+            self.data=np.memmap(self.cache_path+'.bin',dtype=np.uint8,mode='r')
+        i=self.index[path]
+        return self.data[self.offsets[i]:self.offsets[i+1]].reshape(self.shapes[i])
+
+    def get(self,path):
+        if self.index is not None and path in self.index:
+            return np.array(self._read_disk(path))
+        if path in self.memory:
+            self.memory.move_to_end(path)
+            return self.memory[path].copy()
+        image=self.decode(path)
+        if image.nbytes <= self.max_bytes:
+            self.memory[path]=image
+            self.memory_bytes+=image.nbytes
+            while self.memory_bytes > self.max_bytes:
+                _,old_image=self.memory.popitem(last=False)
+                self.memory_bytes-=old_image.nbytes
+            image=image.copy()
+        return image
 
 class ImageDataset(Dataset):
-    def __init__(self,image_paths,labels,transform=None):
+    def __init__(self,image_paths,labels,transform=None,cache=None):
         self.image_paths = image_paths
         self.labels= labels
         self.transform = transform
+        self.cache = cache
 
     def read_image(self,path):
-        image=cv2.imread(path)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image = self.cache.get(path) if self.cache else decode_image(path)
         if self.transform :
             image = self.transform(image)
         return image
@@ -24,25 +116,124 @@ class ImageDataset(Dataset):
         return len(self.image_paths)
 
 class SemanticImageDataset(Dataset):
-    def __init__(self,image_paths,label_paths,transform=None):
+    def __init__(self,image_paths,label_paths,transform=None,cache=None,label_cache=None):
         self.image_paths = image_paths
         self.label_paths= label_paths
         self.transform = transform
+        self.cache = cache
+        self.label_cache = label_cache
 
-    def read_image(self,path):
-        image=cv2.imread(path)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        return image
+    def read_image(self,path,cache=None):
+        return cache.get(path) if cache else decode_image(path)
 
     def __getitem__(self,idx):
-        data = self.read_image(self.image_paths[idx])
-        label = self.read_image(self.label_paths[idx])
-        data,label = self.transform(data,label)
+        data = self.read_image(self.image_paths[idx],self.cache)
+        label = self.read_image(self.label_paths[idx],self.label_cache)
+        if self.transform :
+            data,label = self.transform(data,label)
         return data,label
 
     def __len__(self):
         return len(self.image_paths)
 
+def write_shards(out_dir,image_paths,labels=None,label_paths=None,shard_bytes=1024**3):
+    '''
+    Pack encoded image files (and label_paths for segmentation) into large sequential
+    out_dir/shard-xxxxx.bin files, out_dir/index.npz keep shard/offset/length of every file.
+    '''
+    os.makedirs(out_dir,exist_ok=True)
+    files = [('image',image_paths)] + ([('label',label_paths)] if label_paths is not None else [])
+    index = {}
+    shard_id,shard_size = 0,0
+    f = open(os.path.join(out_dir,'shard-{:05d}.bin'.format(shard_id)),'wb')
+    for name,_ in files:
+        for k in ['shard','offset','length']:
+            index[f'{name}_{k}'] = np.zeros(len(image_paths),dtype=np.int64)
+    for i in range(len(image_paths)):
+        # image and its label mask are stored next to each other
+        for name,paths in files:
+            with open(paths[i],'rb') as image_file:
+                encoded = image_file.read()
+            if shard_size > 0 and shard_size+len(encoded) > shard_bytes:
+                f.close()
+                shard_id,shard_size = shard_id+1,0
+                f = open(os.path.join(out_dir,'shard-{:05d}.bin'.format(shard_id)),'wb')
+            f.write(encoded)
+            index[f'{name}_shard'][i] = shard_id
+            index[f'{name}_offset'][i] = shard_size
+            index[f'{name}_length'][i] = len(encoded)
+            shard_size += len(encoded)
+    f.close()
+    if labels is not None:
+        index['labels'] = np.asarray(labels)
+    np.savez(os.path.join(out_dir,'index.npz'),**index)
+
+class ShardedImageDataset(Dataset):
+    '''
+    Drop-in replacement of ImageDataset(labels)/SemanticImageDataset(label_paths)
+    reading images packed by write_shards, shards are memory-mapped lazily in each worker.
+    '''
+    def __init__(self,shard_dir,transform=None):
+        self.shard_dir = shard_dir
+        self.transform = transform
+        index = np.load(os.path.join(shard_dir,'index.npz'))
+        self.index = {k:index[k] for k in index.files}
+        self.semantic = 'label_shard' in self.index
+        self.shards = {}
+
+    def __getstate__(self):
+        state=self.__dict__.copy()
+        state['shards']={}
+        return state
+
+    def read_image(self,name,idx):
+        shard = self.index[f'{name}_shard'][idx]
+        if shard not in self.shards:
+            self.shards[shard] = np.memmap(os.path.join(self.shard_dir,'shard-{:05d}.bin'.format(shard)),dtype=np.uint8,mode='r')
+        offset = self.index[f'{name}_offset'][idx]
+        encoded = self.shards[shard][offset:offset+self.index[f'{name}_length'][idx]]
+        image = cv2.imdecode(np.asarray(encoded),cv2.IMREAD_COLOR)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    def __getitem__(self,idx):
+        data = self.read_image('image',idx)
+        if self.semantic:
+            label = self.read_image('label',idx)
+            if self.transform :
+                data,label = self.transform(data,label)
+            return data,label
+        if self.transform :
+            data = self.transform(data)
+        return data,self.index['labels'][idx]
+
+    def __len__(self):
+        return len(self.index['image_shard'])
+
+class ShardSampler(Sampler):
+    '''
+    Shuffle shard order and samples inside each shard, keep reads mostly sequential.
+    '''
+    def __init__(self,dataset,shuffle=True,seed=0):
+        self.shard_ids = dataset.index['image_shard']
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self,epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if not self.shuffle:
+            return iter(range(len(self.shard_ids)))
+        rng = np.random.default_rng(self.seed+self.epoch)
+        self.epoch += 1
+        shards = np.unique(self.shard_ids)
+        indices = [rng.permutation(np.flatnonzero(self.shard_ids==s)) for s in rng.permutation(shards)]
+        return iter(np.concatenate(indices).tolist())
+
+    def __len__(self):
+        return len(self.shard_ids)
+
 class NormalDataset(Dataset):
     def __init__(self,data,labels):
         self.data = data
@@ -53,6 +244,57 @@ class NormalDataset(Dataset):
 
     def __len__(self):
         return len(self.labels)
+
+def collate_batch(batch):
+    # batch is already collated by __getitems__
+    return batch
+
+class MemmapDataset(NormalDataset):
+    '''
+    NormalDataset over .npy files opened with np.load(mmap_mode='r') lazily in each worker,
+    so forked workers never copy the arrays. DataLoader fetch a whole batch with __getitems__
+    in one vectorized read, use DataLoader(dataset,batch_size=...,collate_fn=collate_batch).
+    labels_path=None return data only (inference).
+    '''
+    def __init__(self,data_path,labels_path=None):
+        self.data_path = data_path
+        self.labels_path = labels_path
+        self._data = None
+        self._labels = None
+
+    def __getstate__(self):
+        state=self.__dict__.copy()
+        state['_data'],state['_labels']=None,None
+        return state
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.load(self.data_path,mmap_mode='r')
+        return self._data
+
+    @property
+    def labels(self):
+        if self._labels is None and self.labels_path:
+            self._labels = np.load(self.labels_path,mmap_mode='r')
+        return self._labels
+
+    def __getitem__(self,idx):
+        data = torch.from_numpy(np.array(self.data[idx]))
+        if self.labels_path is None:
+            return data
+        return data,torch.from_numpy(np.array(self.labels[idx]))
+
+    def __getitems__(self,indices):
+        # fancy indexing read every row once into a new writable array, from_numpy share it
+        indices = np.asarray(indices)
+        data = torch.from_numpy(self.data[indices])
+        if self.labels_path is None:
+            return data
+        return data,torch.from_numpy(self.labels[indices])
+
+    def __len__(self):
+        return len(self.data)
 # transform = A.Compose([
 #                          A.Resize(cfg.image_size[0],cfg.image_size[1],always_apply=True),
 #                          A.ShiftScaleRotate(shift_limit=0.1,scale_limit=0.2,rotate_limit=0,p=0.5),
@@ -72,9 +314,12 @@ class NormalDataset(Dataset):
 #                    pin_memory=True):
 #     def image_transform(image):
 #         pass
+#     # decode once, epochs after the first one read decoded images from cache/train.bin
+#     cache = ImageCache(cache_path='cache/train',image_size=(256,256)).build(data)
 #     dataset = ImageDataset(image_paths=data,
 #                            labels=labels,
-#                            transform=image_transform)
+#                            transform=image_transform,
+#                            cache=cache)
 #     dataloader = DataLoader(dataset,
 #                             batch_size=batch_size,
 #                             shuffle=shuffle,
@@ -0,0 +1,90 @@
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import numpy as np
+import os
+from torch.utils.data import DataLoader, DistributedSampler, RandomSampler, SequentialSampler
+
+# Multi-process data parallel helpers for Model_Instance(distributed=True)
+# processes are started by torchrun (RANK/WORLD_SIZE/MASTER_ADDR/MASTER_PORT env) or launch(),
+# gloo backend run on CPU-only machines, use nccl for GPUs.
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def init_distributed(backend='gloo',rank=None,world_size=None,init_method='env://'):
+    if is_distributed():
+        return
+    rank = int(os.environ.get('RANK',0)) if rank is None else rank
+    world_size = int(os.environ.get('WORLD_SIZE',1)) if world_size is None else world_size
+    dist.init_process_group(backend,init_method=init_method,rank=rank,world_size=world_size)
+
+def _reduce_device():
+    # nccl only reduce CUDA tensors
+    if dist.get_backend() == 'nccl':
+        return torch.device('cuda',torch.cuda.current_device())
+    return torch.device('cpu')
+
+def all_reduce_array(array,op='sum'):
+    # numpy array reduced over every process, op sum/min/max
+    if not is_distributed():
+        return array
+    ops = {'sum':dist.ReduceOp.SUM,'min':dist.ReduceOp.MIN,'max':dist.ReduceOp.MAX}
+    tensor = torch.from_numpy(np.ascontiguousarray(array)).to(_reduce_device())
+    dist.all_reduce(tensor,op=ops[op])
+    return tensor.cpu().numpy()
+
+def all_gather_object(obj):
+    if not is_distributed():
+        return [obj]
+    gathered = [None]*get_world_size()
+    dist.all_gather_object(gathered,obj)
+    return gathered
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def distributed_dataloader(dataloader,seed=0):
+    '''
+    Rebuild a DataLoader with a DistributedSampler, every process get its own shard.
+    RandomSampler become shuffle=True, SequentialSampler shuffle=False, loaders already
+    using a DistributedSampler (or any sampler with num_replicas) are returned as is.
+    '''
+    sampler = dataloader.sampler
+    if isinstance(sampler,DistributedSampler) or hasattr(sampler,'num_replicas'):
+        return dataloader
+    if not isinstance(sampler,(RandomSampler,SequentialSampler)) or dataloader.batch_size is None:
+        raise Exception(f'{type(sampler).__name__} can not be sharded, give a DataLoader using a DistributedSampler.')
+    return DataLoader(dataloader.dataset,
+                      batch_size=dataloader.batch_size,
+                      sampler=DistributedSampler(dataloader.dataset,shuffle=isinstance(sampler,RandomSampler),seed=seed),
+                      num_workers=dataloader.num_workers,
+                      collate_fn=dataloader.collate_fn,
+                      pin_memory=dataloader.pin_memory,
+                      drop_last=dataloader.drop_last,
+                      timeout=dataloader.timeout,
+                      worker_init_fn=dataloader.worker_init_fn,
+                      persistent_workers=dataloader.persistent_workers)
+
+def _launch_worker(rank,fn,world_size,backend,port,args):
+    os.environ['MASTER_ADDR'] = os.environ.get('MASTER_ADDR','127.0.0.1')
+    os.environ['MASTER_PORT'] = str(port)
+    init_distributed(backend,rank,world_size)
+    try:
+        fn(rank,*args)
+    finally:
+        dist.destroy_process_group()
+
+def launch(fn,world_size,*args,backend='gloo',port=29500):
+    # single node, start world_size processes running fn(rank,*args)
+    mp.spawn(_launch_worker,args=(fn,world_size,backend,port,args),nprocs=world_size,join=True)
@@ -2,10 +2,18 @@ import pandas as pd
 import numpy as np
 import json
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.ticker import MaxNLocator
 from matplotlib.gridspec import SubplotSpec
 import matplotlib as mpl
 import os
+from urllib.parse import quote
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 
 plt.rcParams["font.family"] = "Serif"
@@ -27,52 +35,332 @@ def create_subtitle(fig: plt.Figure, grid: SubplotSpec, title: str):
     row.set_frame_on(False)
     row.axis('off')
 
+class RecordStore:
+    '''
+    Columnar append-only records, one growable float64 array per metric.
+    experiment_name/tag are interned as int codes, DataFrame is only built
+    (and cached) when to_dataframe is called.
+    '''
+    key_columns=['experiment_name','epoch','tag']
+
+    def __init__(self,capacity=64):
+        self.size=0
+        self.capacity=capacity
+        self.experiment_codes=np.zeros(capacity,dtype=np.int32)
+        self.tag_codes=np.zeros(capacity,dtype=np.int32)
+        self.epochs=np.zeros(capacity,dtype=np.int64)
+        self.columns={}
+        self.strings=[]
+        self.string_codes={}
+        self._dataframe=None
+
+    def __len__(self):
+        return self.size
+
+    def intern(self,string):
+        if string not in self.string_codes:
+            self.string_codes[string]=len(self.strings)
+            self.strings.append(string)
+        return self.string_codes[string]
+
+    def _reserve(self,size):
+        if size <= self.capacity:
+            return
+        capacity = max(size,self.capacity*2)
+        def grow(array,fill):
+            new_array=np.full(capacity,fill,dtype=array.dtype)
+            new_array[:self.size]=array[:self.size]
+            return new_array
+        self.experiment_codes=grow(self.experiment_codes,0)
+        self.tag_codes=grow(self.tag_codes,0)
+        self.epochs=grow(self.epochs,0)
+        self.columns={k:grow(v,np.nan) for k,v in self.columns.items()}
+        self.capacity=capacity
+
+    def append(self,experiment_name,tag,epoch,**kwargs):
+        self._reserve(self.size+1)
+        i=self.size
+        self.experiment_codes[i]=self.intern(experiment_name)
+        self.tag_codes[i]=self.intern(tag)
+        self.epochs[i]=epoch
+        for k,v in kwargs.items():
+            if k not in self.columns:
+                self.columns[k]=np.full(self.capacity,np.nan)
+            self.columns[k][i]=v
+        self.size+=1
+        self._dataframe=None
+        return i
+
+    def extend(self,dataframe):
+        n=len(dataframe)
+        self._reserve(self.size+n)
+        rows=slice(self.size,self.size+n)
+        for codes,name in [(self.experiment_codes,'experiment_name'),(self.tag_codes,'tag')]:
+            index,strings=pd.factorize(dataframe[name])
+            codes[rows]=np.array([self.intern(s) for s in strings],dtype=np.int32)[index]
+        self.epochs[rows]=dataframe['epoch'].to_numpy(dtype=np.int64)
+        for k in dataframe.columns:
+            if k in RecordStore.key_columns:
+                continue
+            if k not in self.columns:
+                self.columns[k]=np.full(self.capacity,np.nan)
+            self.columns[k][rows]=dataframe[k].to_numpy(dtype=np.float64)
+        self.size+=n
+        self._dataframe=None
+
+    def remove(self,experiment_name,tag=None):
+        if experiment_name not in self.string_codes or (tag is not None and tag not in self.string_codes):
+            return
+        keep = self.experiment_codes[:self.size] != self.string_codes[experiment_name]
+        if tag is not None:
+            keep |= self.tag_codes[:self.size] != self.string_codes[tag]
+        size = int(keep.sum())
+        self.experiment_codes[:size]=self.experiment_codes[:self.size][keep]
+        self.tag_codes[:size]=self.tag_codes[:self.size][keep]
+        self.epochs[:size]=self.epochs[:self.size][keep]
+        for v in self.columns.values():
+            v[:size]=v[:self.size][keep]
+            v[size:]=np.nan
+        self.size=size
+        self._dataframe=None
+
+    def experiments(self):
+        codes = pd.unique(self.experiment_codes[:self.size])
+        return [self.strings[c] for c in codes]
+
+    def count(self,experiment_name):
+        if experiment_name not in self.string_codes:
+            return 0
+        return int((self.experiment_codes[:self.size] == self.string_codes[experiment_name]).sum())
+
+    def experiment_dataframe(self,experiment_name,start=0):
+        # rows of one experiment from its start-th row, only columns it use
+        rows = np.flatnonzero(self.experiment_codes[:self.size] == self.string_codes[experiment_name])[start:]
+        data={'experiment_name':np.full(len(rows),experiment_name,dtype=object),
+              'epoch':self.epochs[rows],
+              'tag':np.array(self.strings,dtype=object)[self.tag_codes[rows]]}
+        data.update({k:v[rows] for k,v in self.columns.items() if not np.isnan(v[rows]).all()})
+        return pd.DataFrame(data)
+
+    def column(self,name):
+        return self.columns[name][:self.size]
+
+    def series_index(self,experiments=None):
+        '''
+        Group rows once into {(experiment_name,tag,category):values}.
+        A category is only kept if it has no missing value in the (experiment_name,tag) group.
+        '''
+        experiment_codes=self.experiment_codes[:self.size]
+        tag_codes=self.tag_codes[:self.size]
+        rows=np.arange(self.size)
+        if experiments is not None:
+            codes=[self.string_codes[e] for e in experiments if e in self.string_codes]
+            rows=rows[np.isin(experiment_codes,codes)]
+        # stable sort keep record order inside each group
+        order=rows[np.lexsort((rows,tag_codes[rows],experiment_codes[rows]))]
+        group_keys=experiment_codes[order].astype(np.int64)*len(self.strings)+tag_codes[order]
+        boundaries=np.flatnonzero(np.diff(group_keys))+1
+        series={}
+        for group in np.split(order,boundaries):
+            if len(group)==0:
+                continue
+            key=(self.strings[experiment_codes[group[0]]],self.strings[tag_codes[group[0]]])
+            for k,v in self.columns.items():
+                values=v[group]
+                if not np.isnan(values).any():
+                    series[key+(k,)]=values
+        return series
+
+    def row(self,index):
+        record={k:v[index] for k,v in self.columns.items()}
+        record['tag']=self.strings[self.tag_codes[index]]
+        record['experiment_name']=self.strings[self.experiment_codes[index]]
+        record['epoch']=self.epochs[index]
+        return pd.Series(record,name=index)
+
+    def to_dataframe(self):
+        if self._dataframe is None:
+            strings=np.array(self.strings,dtype=object)
+            data={'experiment_name':strings[self.experiment_codes[:self.size]],
+                  'epoch':self.epochs[:self.size].copy(),
+                  'tag':strings[self.tag_codes[:self.size]]}
+            data.update({k:v[:self.size].copy() for k,v in self.columns.items()})
+            self._dataframe=pd.DataFrame(data)
+        return self._dataframe
+
+class BestTracker:
+    '''
+    Running best value/index of one category, update is O(1) per record.
+    Records without the category (nan) only move the index forward.
+    '''
+    def __init__(self,mode='min'):
+        if mode not in ['min','max']:
+            raise Exception(f'{mode} mode not support, use min or max.')
+        self.mode=mode
+        self.best_value=np.nan
+        self.best_index=-1
+        self.count=0
+
+    def is_better(self,value):
+        if self.best_index < 0:
+            return True
+        return value < self.best_value if self.mode == 'min' else value > self.best_value
+
+    def update(self,value):
+        index=self.count
+        self.count+=1
+        if value is not None and not np.isnan(value) and self.is_better(value):
+            self.best_value=value
+            self.best_index=index
+            return True
+        return False
+
+    def extend(self,values):
+        values=np.asarray(values,dtype=np.float64)
+        if (~np.isnan(values)).any():
+            index = np.nanargmin(values) if self.mode == 'min' else np.nanargmax(values)
+            if self.is_better(values[index]):
+                self.best_value=values[index]
+                self.best_index=self.count+index
+        self.count+=len(values)
+
+    def is_best(self):
+        return self.best_index >= 0 and self.best_index == self.count-1
+
+    def since_best(self):
+        return self.count-1-self.best_index if self.best_index >= 0 else self.count
+
 class Logger:
     save_dir='logger_dir'
     config=None
     loaded=False
     experiment_name=None
-    history={'records':pd.DataFrame(columns=['experiment_name','epoch','tag']),
+    history={'records':RecordStore(),
              'configs':{}}
 
     @staticmethod
     def init(experiment_name,overwrite=False):
         Logger.config=Config()
         Logger.experiment_name=experiment_name
-        if experiment_name in Logger.history['records'].experiment_name.unique() and not overwrite:
+        if experiment_name in Logger.history['records'].experiments() and not overwrite:
             raise Exception(f'{experiment_name} experiment name already exist, please rename or set overwrite parameter to True.')
-        Logger.history['records'] = Logger.history['records'][Logger.history['records'].experiment_name != experiment_name]
+        Logger.history['records'].remove(experiment_name)
+        Logger._mark_stale(experiment_name)
 
     def __init__(self,tag):
         if not Logger.experiment_name:
             raise Exception('Use Logger.init(experiment_name) to initial Logger first.')
 
         self.tag=tag
-        self.record=pd.DataFrame()
+        self.store=RecordStore()
+        self.best_trackers={}
         self.epoch=0
         if not os.path.exists(Logger.save_dir):
             os.mkdir(Logger.save_dir)
 
+    @property
+    def record(self):
+        record = self.store.to_dataframe()
+        return record[list(self.store.columns.keys())+['tag','experiment_name','epoch']]
+
     def __call__(self,**kwargs):
-        new_row = pd.DataFrame(kwargs,index=[self.epoch],dtype=np.float64)
-        new_row['tag']=self.tag
-        new_row['experiment_name']=Logger.experiment_name
-        new_row['epoch']=self.epoch
-        self.record=pd.concat([self.record,new_row])
-        Logger.history['records'] = pd.concat([Logger.history['records'],new_row])
+        self.store.append(Logger.experiment_name,self.tag,self.epoch,**kwargs)
+        Logger.history['records'].append(Logger.experiment_name,self.tag,self.epoch,**kwargs)
+        for (category,mode),tracker in self.best_trackers.items():
+            tracker.update(kwargs.get(category,np.nan))
         self.epoch+=1
 
     def get_last_record(self):
-        return self.record.iloc[-1]
+        return self.store.row(len(self.store)-1)
+
+    def track_best(self,category='loss',mode='min'):
+        # several (category,mode) can be tracked at the same time
+        if (category,mode) not in self.best_trackers:
+            tracker=BestTracker(mode)
+            if category in self.store.columns:
+                tracker.extend(self.store.column(category))
+            else:
+                tracker.count=len(self.store)
+            self.best_trackers[(category,mode)]=tracker
+        return self.best_trackers[(category,mode)]
 
     def get_best_record(self,category='loss',mode='min'):
-        best_index = self.record[category].idxmin() if mode == 'min' else self.record[category].idxmax()
-        return best_index, self.record.iloc[best_index]
+        best_index = self.track_best(category,mode).best_index
+        if best_index < 0:
+            raise Exception(f'{category} has no record in {self.tag} logger.')
+        return best_index, self.store.row(best_index)
 
     def check_best(self,category='loss',mode='min'):
-        best_index,best_record = self.get_best_record(category,mode)
-        return (len(self.record)-1)==best_index
+        return self.track_best(category,mode).is_best()
+
+    def early_stop(self,category='loss',mode='min',patience=10):
+        # True if category didn't improve in the last patience records
+        return self.track_best(category,mode).since_best() >= patience
+
+    def state_dict(self):
+        # logger position saved in training checkpoints
+        return {'tag':self.tag,
+                'epoch':self.epoch,
+                'records':self.store.to_dataframe().copy(),
+                'best_trackers':list(self.best_trackers.keys())}
+
+    def load_state_dict(self,state):
+        # records logged after the checkpoint are dropped from this logger and Logger.history
+        records=state['records']
+        records=records[records['experiment_name'] == Logger.experiment_name]
+        self.store=RecordStore()
+        Logger.history['records'].remove(Logger.experiment_name,self.tag)
+        if len(records):
+            self.store.extend(records)
+            Logger.history['records'].extend(records)
+        Logger._mark_stale(Logger.experiment_name)
+        self.epoch=state['epoch']
+        self.best_trackers={}
+        for category,mode in state['best_trackers']:
+            self.track_best(category,mode)
+
 
+    @staticmethod
+    def _new_figure(nrows,ncols,figsize,show):
+        # headless Agg figure when not showing, keeps pyplot state untouched
+        if show:
+            fig = plt.figure(figsize=figsize)
+        else:
+            fig = Figure(figsize=figsize)
+            FigureCanvasAgg(fig)
+        axs = fig.subplots(nrows,ncols,squeeze=False)
+        for ax in axs.flatten():
+            ax.ticklabel_format(style='plain', axis='x', useOffset=False)
+        return fig, axs.flatten()
+
+    @staticmethod
+    def _plot_series(ax,values,label,color,fontsize,max_points=None):
+        x = np.arange(len(values))
+        if max_points and len(values) > max_points:
+            # keep every n-th point and the last one
+            keep = np.unique(np.append(np.linspace(0,len(values)-1,max_points).astype(np.int64),len(values)-1))
+            x,values = x[keep],values[keep]
+        ax.plot(x,values,label=label,color=color,linewidth=2)
+
+    @staticmethod
+    def _format_axis(ax,category,fontsize,ylim):
+        ax.set_title('{}'.format(category), fontsize=20)
+        if ax.lines:
+            ax.legend(loc='upper left',fontsize=fontsize)
+        ax.tick_params(axis='both', labelsize=fontsize)
+        ax.grid(axis='y', linestyle='-', alpha=0.7,color='lightgray')
+        ax.xaxis.set_major_locator(MaxNLocator(integer=True))
+        if category in ylim.keys():
+            ax.set_ylim(ylim[category][0],ylim[category][1])
+
+    @staticmethod
+    def _finish_figure(fig,filename,save,show):
+        fig.tight_layout()
+        if save:
+            fig.savefig(os.path.join(Logger.save_dir, filename))
+        if show:
+            plt.show()
+            plt.close(fig)
 
     @staticmethod
     def plot(show_experiment=None,show_tag=None,
@@ -82,67 +370,44 @@ class Logger:
              ylim={},
              filename='logger_plot.png',
              save=True,
-             show=True):
+             show=True,
+             max_points=None):
 
         if not show_experiment:
             show_experiment=Logger.experiment_name
 
         if isinstance(show_experiment,list):
-            Logger.plot_multi_experiment(show_experiment=show_experiment,show_tag=show_tag,
+            Logger.plot_experiments(show_experiment=show_experiment,show_tag=show_tag,
              show_category=show_category,
              figsize=figsize,
              cmp=cmp,
              ylim=ylim,
              filename=filename,
              save=save,
-             show=show)
+             show=show,
+             max_points=max_points)
             return
 
-
-
-        history_df =  Logger.history['records']
-        history_df = history_df[history_df.experiment_name == show_experiment].drop(columns=['experiment_name'])
-
+        series = Logger.history['records'].series_index([show_experiment])
         if not show_tag:
-            show_tag = list(history_df.tag.unique())
-
-        exist_category=set([])
-        for logger_tag in show_tag:
-            _tmp=history_df[history_df.tag==logger_tag].drop(columns=['epoch','tag'])
-            _tmp = _tmp.dropna(axis=1)
-            exist_category.update(_tmp.columns)
+            show_tag = list(dict.fromkeys(t for _,t,_ in series))
 
+        exist_category=set(c for _,t,c in series if t in show_tag)
         if show_category:
             show_category = [c for c in show_category if c in exist_category]
         else:
             show_category=sorted(exist_category)
 
-        fig, axs = plt.subplots(1,len(show_category),figsize=(len(show_category)*figsize[0]+len(show_category)*0.25,figsize[1]))#,constrained_layout=True)
-        plt.ticklabel_format(style='plain', axis='x', useOffset=False)
-
-        axs = np.array(axs).flatten()
-
+        fig, axs = Logger._new_figure(1,len(show_category),(len(show_category)*figsize[0]+len(show_category)*0.25,figsize[1]),show)
         for lidx,logger_tag in enumerate(show_tag):
-            plot_color = cmp[lidx]
+            plot_color = cmp[lidx%len(cmp)]
             for cidx,c in enumerate(show_category):
-                if c in history_df[history_df.tag==logger_tag].drop(columns=['epoch','tag']).dropna(axis=1).columns:
-                    _record=history_df[history_df.tag==logger_tag]
-                    _record = _record.reset_index(drop=True)
-                    axs[cidx].plot(range(len(_record)),_record[c],label=logger_tag,color=plot_color,linewidth=2)
-                    axs[cidx].set_title('{}'.format(c), fontsize=20)
-                    axs[cidx].legend(loc='upper left',fontsize=17)
-                    axs[cidx].tick_params(axis='both', labelsize=17)
-                    axs[cidx].grid(axis='y', linestyle='-', alpha=0.7,color='lightgray')
-                    axs[cidx].xaxis.set_major_locator(MaxNLocator(integer=True))
-                    if c in ylim.keys():
-                        axs[cidx].set_ylim(ylim[c][0],ylim[c][1])
-        fig.suptitle(Logger.experiment_name, fontsize=22)
-        plt.tight_layout()
-        if save:
-            plt.savefig(os.path.join(Logger.save_dir, filename))
-        if show:
-            plt.show()
-        plt.close()
+                if (show_experiment,logger_tag,c) in series:
+                    Logger._plot_series(axs[cidx],series[(show_experiment,logger_tag,c)],logger_tag,plot_color,17,max_points)
+        for cidx,c in enumerate(show_category):
+            Logger._format_axis(axs[cidx],c,17,ylim)
+        fig.suptitle(show_experiment, fontsize=22)
+        Logger._finish_figure(fig,filename,save,show)
 
     @staticmethod
     def plot_experiments(show_experiment=None,show_tag=None,
@@ -152,10 +417,11 @@ class Logger:
              ylim={},
              filename='experiments_history.png',
              save=True,
-             show=True):
+             show=True,
+             max_points=None):
 
         if not show_experiment:
-            show_experiment=list(Logger.history['records'].experiment_name.unique())
+            show_experiment=Logger.history['records'].experiments()
 
         if len(show_experiment)==1:
             show_experiment=show_experiment[0]
@@ -168,63 +434,48 @@ class Logger:
              ylim=ylim,
              filename=filename,
              save=save,
-             show=show)
+             show=show,
+             max_points=max_points)
             return
-        history_df =  Logger.history['records']
-        history_df = history_df[history_df.experiment_name.apply(lambda x: x in show_experiment )]
-        if not show_tag:
-            show_tag = list(history_df.tag.unique())
 
-        exist_category=set([])
-        for logger_tag in show_tag:
-            _tmp=history_df[history_df.tag==logger_tag].drop(columns=['epoch','tag','experiment_name'])
-            _tmp = _tmp.dropna(axis=1)
-            exist_category.update(_tmp.columns)
+        # (experiment,tag,category) -> values, built once for every subplot
+        series = Logger.history['records'].series_index(show_experiment)
+        if not show_tag:
+            show_tag = list(dict.fromkeys(t for _,t,_ in series))
 
+        exist_category=set(c for _,t,c in series if t in show_tag)
         if show_category:
             show_category = [c for c in show_category if c in exist_category]
         else:
             show_category=sorted(exist_category)
 
-        fig, axs = plt.subplots(len(show_tag),len(show_category),figsize=(len(show_category)*figsize[0]+len(show_category)*0.25,(figsize[1]+1)*len(show_tag)))#,constrained_layout=True)
-        plt.ticklabel_format(style='plain', axis='x', useOffset=False)
+        fig, axs = Logger._new_figure(len(show_tag),len(show_category),(len(show_category)*figsize[0]+len(show_category)*0.25,(figsize[1]+1)*len(show_tag)),show)
 
-        axs = np.array(axs).flatten()
-
-        grid = plt.GridSpec(len(show_tag), len(show_category))
+        grid = fig.add_gridspec(len(show_tag), len(show_category))
         for lidx,logger_tag in enumerate(show_tag):
             create_subtitle(fig, grid[lidx, ::], logger_tag)
             for cidx,c in enumerate(show_category):
                 axidx = lidx*len(show_category)+cidx
                 for nidx,n in enumerate(show_experiment):
-                    plot_color = cmp[nidx]
-                    _record=history_df[(history_df.tag==logger_tag) & (history_df.experiment_name==n)]
-                    if c in _record.drop(columns=['epoch','tag']).dropna(axis=1).columns:
-                        _record = _record.reset_index(drop=True)
-                        axs[axidx].plot(range(len(_record)),_record[c],label='{}({})'.format(n,logger_tag),color=plot_color,linewidth=2)
-                        axs[axidx].set_title('{}'.format(c), fontsize=20)
-                        axs[axidx].legend(loc='upper left',fontsize=15)
-                        axs[axidx].tick_params(axis='both', labelsize=15)
-                        axs[axidx].grid(axis='y', linestyle='-', alpha=0.7,color='lightgray')
-                        axs[axidx].xaxis.set_major_locator(MaxNLocator(integer=True))
-                        if c in ylim.keys():
-                            axs[axidx].set_ylim(ylim[c][0],ylim[c][1])
-        plt.tight_layout()
-        if save:
-            plt.savefig(os.path.join(Logger.save_dir,filename))
-        if show:
-            plt.show()
-        plt.close()
+                    plot_color = cmp[nidx%len(cmp)]
+                    if (n,logger_tag,c) in series:
+                        Logger._plot_series(axs[axidx],series[(n,logger_tag,c)],'{}({})'.format(n,logger_tag),plot_color,15,max_points)
+                Logger._format_axis(axs[axidx],c,15,ylim)
+        Logger._finish_figure(fig,filename,save,show)
 
     @staticmethod
     def remove_history(experiment_name):
-        Logger.history['records'] = Logger.history['records'][Logger.history['records'].experiment_name != experiment_name]
+        Logger.history['records'].remove(experiment_name)
+        Logger._mark_stale(experiment_name)
         if experiment_name in Logger.history['configs'].keys():
             del Logger.history['configs'][experiment_name]
 
     @staticmethod
-    def export_logger(dir_path=None,filename='logger_history',overwrite=False):
+    def export_logger(dir_path=None,filename='logger_history',overwrite=False,format='csv'):
         if not dir_path: dir_path = Logger.save_dir
+        if format == 'parquet':
+            Logger.export_parquet(dir_path=dir_path,filename=filename,overwrite=overwrite)
+            return
         save_path=os.path.join(dir_path,filename)
         if os.path.exists(save_path+'.csv') and not overwrite and not Logger.loaded:
             Logger.load_logger(dir_path=dir_path,filename=filename)
@@ -235,29 +486,141 @@ class Logger:
             json_str=json.dumps(Logger.history['configs'], indent=2, sort_keys=True)
             f.write(json_str)
 
-        Logger.history['records'].to_csv(save_path+'.csv',index=False)
+        Logger.history['records'].to_dataframe().to_csv(save_path+'.csv',index=False)
 
     @staticmethod
-    def load_logger(dir_path=None,filename='logger_history',overwrite=False):
+    def load_logger(dir_path=None,filename='logger_history',overwrite=False,format='csv',experiments=None):
         if not dir_path: dir_path = Logger.save_dir
+        if format == 'parquet':
+            Logger.load_parquet(dir_path=dir_path,filename=filename,overwrite=overwrite,experiments=experiments)
+            return
         filepath = os.path.join(dir_path,filename)
         previous_history = pd.read_csv(filepath+'.csv')
         with open(filepath+'.json','r') as json_file:
             Logger.history['configs'] = json.load(json_file)
 
-        repeat_names=set(previous_history.experiment_name.unique()) & set(Logger.history['records'].experiment_name.unique())
+        repeat_names=set(previous_history.experiment_name.unique()) & set(Logger.history['records'].experiments())
         if len(repeat_names) != 0 and not overwrite:
             raise Exception(f'{repeat_names} experiment name already exist, please rename or set overwrite parameter to True.')
         elif len(repeat_names) != 0:
             previous_history=previous_history.loc[~previous_history.experiment_name.isin(repeat_names)]
-            Logger.history['configs'] = json.load(json_file)
-            if len(repeat_names)>0:
-                for k in Logger.history['configs'].keys():
-                    if k in repeat_names:
-                        del Logger.history['configs'][k]
+            Logger.history['configs'] = {k:v for k,v in Logger.history['configs'].items() if k not in repeat_names}
         Logger.loaded=True
-        Logger.history['records']=pd.concat([previous_history,Logger.history['records']])
+        records=RecordStore()
+        records.extend(previous_history)
+        records.extend(Logger.history['records'].to_dataframe())
+        Logger.history['records']=records
+
+    # Parquet history, one partition directory per experiment:
+    # <filename>/index.json                        experiments -> partition, parts, rows, config
+    # <filename>/experiment=<name>/part-00000.parquet ...
+    # export only write rows appended since last export/load as a new part.
+    synced_experiments={}
+    # exported experiments whose in-memory history was dropped (init(overwrite=True)/remove_history/
+    # load_state_dict), their partitions are rewritten on next export
+    stale_experiments={}
+
+    @staticmethod
+    def _mark_stale(experiment_name):
+        for path,synced in Logger.synced_experiments.items():
+            if experiment_name in synced:
+                synced.discard(experiment_name)
+                Logger.stale_experiments.setdefault(path,set()).add(experiment_name)
 
+    @staticmethod
+    def _read_index(history_path):
+        index_path=os.path.join(history_path,'index.json')
+        if not os.path.exists(index_path):
+            return {'experiments':{}}
+        with open(index_path,'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write_index(history_path,index):
+        index_path=os.path.join(history_path,'index.json')
+        with open(index_path+'.tmp','w') as f:
+            f.write(json.dumps(index, indent=2, sort_keys=True))
+        os.replace(index_path+'.tmp',index_path)
+
+    @staticmethod
+    def export_parquet(dir_path=None,filename='logger_history',overwrite=False):
+        if pa is None:
+            raise ImportError('parquet logger history need pyarrow, pip install pyarrow')
+        if not dir_path: dir_path = Logger.save_dir
+        history_path=os.path.join(dir_path,filename)
+        os.makedirs(history_path,exist_ok=True)
+        index=Logger._read_index(history_path)
+        synced=Logger.synced_experiments.setdefault(os.path.abspath(history_path),set())
+        stale=Logger.stale_experiments.setdefault(os.path.abspath(history_path),set())
+        records=Logger.history['records']
+        if Logger.experiment_name:
+            Logger.history['configs'][Logger.experiment_name]=Logger.config
+
+        # experiments removed by remove_history/init(overwrite=True)
+        for name in list(synced|stale):
+            if records.count(name) == 0 and (name in stale or name != Logger.experiment_name) and name in index['experiments']:
+                partition=os.path.join(history_path,index['experiments'].pop(name)['partition'])
+                for part in os.listdir(partition):
+                    os.remove(os.path.join(partition,part))
+                os.rmdir(partition)
+                synced.discard(name)
+                stale.discard(name)
+
+        for name in records.experiments():
+            entry=index['experiments'].get(name)
+            if entry and name not in synced and name not in stale and not overwrite:
+                raise Exception(f'{name} experiment name already exist, please rename or set overwrite parameter to True.')
+            if entry is None:
+                entry={'partition':'experiment='+quote(name,safe=''),'parts':[],'rows':0}
+            partition=os.path.join(history_path,entry['partition'])
+            os.makedirs(partition,exist_ok=True)
+
+            n_rows=records.count(name)
+            if name not in synced or n_rows < entry['rows']:
+                # rewrite partition
+                for part in entry['parts']:
+                    os.remove(os.path.join(partition,part))
+                entry['parts'],entry['rows']=[],0
+            if n_rows > entry['rows']:
+                part='part-{:05d}.parquet'.format(len(entry['parts']))
+                table=pa.Table.from_pandas(records.experiment_dataframe(name,start=entry['rows']),preserve_index=False)
+                pq.write_table(table,os.path.join(partition,part))
+                entry['parts'].append(part)
+                entry['rows']=n_rows
+            entry['config']=Logger.history['configs'].get(name,{})
+            index['experiments'][name]=entry
+            synced.add(name)
+            stale.discard(name)
+        Logger._write_index(history_path,index)
+
+    @staticmethod
+    def load_parquet(dir_path=None,filename='logger_history',overwrite=False,experiments=None):
+        if pa is None:
+            raise ImportError('parquet logger history need pyarrow, pip install pyarrow')
+        if not dir_path: dir_path = Logger.save_dir
+        history_path=os.path.join(dir_path,filename)
+        index=Logger._read_index(history_path)
+        if experiments is None:
+            experiments=list(index['experiments'].keys())
+        elif isinstance(experiments,str):
+            experiments=[experiments]
+
+        repeat_names=set(experiments) & set(Logger.history['records'].experiments())
+        if len(repeat_names) != 0 and not overwrite:
+            raise Exception(f'{repeat_names} experiment name already exist, please rename or set overwrite parameter to True.')
+        synced=Logger.synced_experiments.setdefault(os.path.abspath(history_path),set())
+        for name in experiments:
+            if name in repeat_names:
+                continue
+            entry=index['experiments'][name]
+            partition=os.path.join(history_path,entry['partition'])
+            if entry['parts']:
+                previous_history=pd.concat([pq.read_table(os.path.join(partition,part)).to_pandas() for part in entry['parts']])
+                Logger.history['records'].extend(previous_history)
+            Logger.history['configs'][name]=entry.get('config',{})
+            synced.add(name)
+            Logger.stale_experiments.get(os.path.abspath(history_path),set()).discard(name)
+        Logger.loaded=True
 
 
 #教學
@@ -289,6 +652,8 @@ if __name__ == '__main__':
         all_logger(acc=np.random.rand(),f1score=np.random.rand(),ff=np.random.rand(),f1=np.random.rand())
         validation_logger(acc=np.random.rand())
         validation_logger.check_best(category='acc',mode='max')
+        if validation_logger.early_stop(category='acc',mode='max',patience=5):
+            break
 
     Logger.plot(show_category=None,
                 ylim={'acc':[0,1]},
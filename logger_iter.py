@@ -5,6 +5,7 @@ from matplotlib.ticker import MaxNLocator
 import matplotlib as mpl
 import pickle
 import os
+from logger import BestTracker
 
 plt.rcParams["font.family"] = "Serif"
 
@@ -18,6 +19,10 @@ class Logger:
         self.history=pd.DataFrame()
         self.current_history=pd.DataFrame()
         Logger.logger_dict[self.name] = pd.DataFrame()
+        # per-epoch average Series, epoch_history build the DataFrame on demand
+        self.epoch_averages=[]
+        self.best_trackers={}
+        self.iter_count=0
         self.epoch=0
         if not os.path.exists(Logger.save_dir):
             os.mkdir(Logger.save_dir)
@@ -43,26 +48,57 @@ class Logger:
                 output_str+= 'avg{}:{} \t'.format(log_c,f'%.{r}f'%avg_epoch[log_c])
             return output_str
 
+    @property
+    def epoch_history(self):
+        # one row of averages per epoch, e.g. logger.epoch_history['loss'].iloc[-1]
+        return pd.DataFrame(self.epoch_averages).reset_index(drop=True)
+
     def get_current_epoch_avg(self):
         return self.current_history.mean()
 
     def get_last_epoch_avg(self):
         return self.history[self.history.epoch == (self.epoch-1)].mean()
 
+    def track_best(self,category='loss',mode='min',unit='epoch'):
+        # several (category,mode,unit) can be tracked at the same time
+        if (category,mode,unit) not in self.best_trackers:
+            tracker=BestTracker(mode)
+            if unit == 'epoch':
+                tracker.extend([avg.get(category,np.nan) for avg in self.epoch_averages])
+            elif category in self.history:
+                tracker.extend(self.history[category].to_numpy())
+            else:
+                tracker.count=self.iter_count
+            self.best_trackers[(category,mode,unit)]=tracker
+        return self.best_trackers[(category,mode,unit)]
+
     def get_best_record(self,category='loss',mode='min',unit='epoch'):
-        _history = self.history.groupby('epoch').mean() if unit == 'epoch' else self.history
-        best_index = _history[category].idxmin() if mode == 'min' else _history[category].idxmax()
-        return best_index, _history.iloc[best_index]
+        best_index = self.track_best(category,mode,unit).best_index
+        if best_index < 0:
+            raise Exception(f'{category} has no record in {self.name} logger.')
+        return best_index, self.epoch_averages[best_index] if unit == 'epoch' else self.history.iloc[best_index]
 
     def check_best(self,category='loss',mode='min',unit='epoch'):
-        _history = self.history.groupby('epoch').mean() if unit == 'epoch' else self.history
-        best_index,best_record = self.get_best_record(category,mode,unit)
-        return (len(_history[category])-1)==best_index
+        return self.track_best(category,mode,unit).is_best()
+
+    def early_stop(self,category='loss',mode='min',patience=10,unit='epoch'):
+        # True if category didn't improve in the last patience epochs(iters)
+        return self.track_best(category,mode,unit).since_best() >= patience
 
     def save_epoch(self):
         self.update_category()
         current_category=self.current_history.columns
         self.current_history['epoch'] = self.epoch
+        epoch_avg = self.current_history.astype(np.float64).mean()
+        self.epoch_averages.append(epoch_avg)
+        for (category,mode,unit),tracker in self.best_trackers.items():
+            if unit == 'epoch':
+                tracker.update(epoch_avg.get(category,np.nan))
+            elif category in self.current_history:
+                tracker.extend(self.current_history[category].to_numpy())
+            else:
+                tracker.count+=len(self.current_history)
+        self.iter_count+=len(self.current_history)
         self.epoch += 1
         self.history =pd.concat([self.history,self.current_history.copy()]) #self.history.append(self.current_history.copy()).reset_index(drop=True)
         self.current_history=pd.DataFrame(columns=current_category)
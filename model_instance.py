@@ -1,12 +1,19 @@
 import torch
 from torch.nn import init
 from torch import autocast
-from torch.cuda.amp import GradScaler
+from torch.amp import GradScaler
 import torch.functional as F
 import numpy as np
 from tqdm.auto import tqdm
 from sklearn.linear_model import LogisticRegression
 import os
+from contextlib import nullcontext
+import json
+from utils import map_tensors, batch_length, split_batch, concat_batches, DevicePrefetcher, DynamicBatcher, TransferPolicy, CompiledModule, compile_modes, to_float, is_out_of_memory, SavedTensorMemory
+from torch.utils.data import default_collate
+from torch.nn.parallel import DistributedDataParallel
+from distributed import init_distributed, is_main_process, get_world_size, distributed_dataloader, all_reduce_array, all_gather_object
+from checkpoint import training_state, load_training_state, atomic_save, load_file, load_model_state
 from sklearn.metrics import accuracy_score,precision_recall_fscore_support, roc_auc_score, f1_score, recall_score, precision_score
 
 
@@ -28,6 +35,98 @@ def calculate_metrics(metrics_name):#List
         raise Exception(f'{set(metrics_name) - set(metrics_functions.keys())} metrics not support')
     return lambda pred,label: {name:metrics_functions[name](pred,label)for name in metrics_name}
 
+class StreamingMetrics():
+    '''
+    Incremental version of calculate_metrics.
+    acc/f1score/recall/precision come from a running confusion matrix and auroc
+    from fixed-bin score histograms, so memory does not grow with dataset size.
+    auroc score is pred (N,) or pred[:,1] like calculate_metrics, binned after a sigmoid so logits
+    and probabilities both keep their ranking (roc_auc_score up to ties inside a bin).
+    '''
+    support_metrics=['acc','f1_score','f1score','recall','precision','auroc']
+
+    def __init__(self,metrics_name,auroc_bins=10000):
+        if not set(metrics_name).issubset(set(StreamingMetrics.support_metrics)):
+            raise Exception(f'{set(metrics_name) - set(StreamingMetrics.support_metrics)} metrics not support')
+        self.metrics_name=list(metrics_name)
+        self.auroc_bins=auroc_bins
+        self.reset()
+
+    def reset(self):
+        self.confusion_matrix=np.zeros((2,2),dtype=np.int64)
+        self.pos_hist=np.zeros(self.auroc_bins,dtype=np.int64)
+        self.neg_hist=np.zeros(self.auroc_bins,dtype=np.int64)
+
+    def _grow(self,num_classes):
+        if num_classes <= len(self.confusion_matrix):
+            return
+        confusion_matrix=np.zeros((num_classes,num_classes),dtype=np.int64)
+        n=len(self.confusion_matrix)
+        confusion_matrix[:n,:n]=self.confusion_matrix
+        self.confusion_matrix=confusion_matrix
+
+    def update(self,pred,label):
+        pred = pred.float().numpy() if torch.is_tensor(pred) else np.asarray(pred)
+        label = label.numpy() if torch.is_tensor(label) else np.asarray(label)
+
+        # binary output (N,) / (N,1,...) or class scores (N,C,...)
+        binary = len(pred.shape)==1 or pred.shape[1]==1
+        if binary:
+            score = pred.reshape(-1)
+            pred_class = (score>=0.5).astype(np.int64)
+        else:
+            score = pred[:,1].reshape(-1)
+            pred_class = pred.argmax(axis=1).reshape(-1)
+        label = label.reshape(-1).astype(np.int64)
+
+        num_classes = max(2 if binary else pred.shape[1], int(label.max())+1 if len(label) else 0)
+        self._grow(num_classes)
+        num_classes = len(self.confusion_matrix)
+        self.confusion_matrix += np.bincount(label*num_classes+pred_class,
+                                             minlength=num_classes*num_classes).reshape(num_classes,num_classes)
+
+        if 'auroc' in self.metrics_name:
+            # monotonic squash into [0,1], float64 keep logits up to ~+-36 apart
+            score = 1./(1.+np.exp(-score.astype(np.float64)))
+            self.pos_hist += np.histogram(score[label==1],bins=self.auroc_bins,range=(0.,1.))[0]
+            self.neg_hist += np.histogram(score[label!=1],bins=self.auroc_bins,range=(0.,1.))[0]
+
+    def _macro(self,numerator,denominator):
+        # sklearn macro average: classes seen in label or pred, zero_division=0
+        present = (self.confusion_matrix.sum(axis=0)+self.confusion_matrix.sum(axis=1))>0
+        score = np.divide(numerator,denominator,out=np.zeros(len(numerator)),where=denominator>0)
+        return float(score[present].mean()) if present.any() else 0.
+
+    def auroc(self):
+        if self.confusion_matrix.sum(axis=1)[2:].sum() > 0:
+            raise Exception('auroc only support binary labels (0/1).')
+        n_pos,n_neg = self.pos_hist.sum(),self.neg_hist.sum()
+        if n_pos==0 or n_neg==0:
+            return float('nan')
+        # P(score_pos > score_neg) + 0.5*P(same bin)
+        neg_below = np.cumsum(self.neg_hist)-self.neg_hist
+        return float((self.pos_hist*(neg_below+0.5*self.neg_hist)).sum()/(n_pos*n_neg))
+
+    def compute(self):
+        cm = self.confusion_matrix
+        tp = np.diag(cm).astype(np.float64)
+        pred_count,label_count = cm.sum(axis=0),cm.sum(axis=1)
+        metrics_functions={}
+        metrics_functions['acc']=lambda : float(tp.sum()/max(cm.sum(),1))
+        metrics_functions['f1_score']=lambda : self._macro(2*tp,pred_count+label_count)
+        metrics_functions['f1score']=metrics_functions['f1_score']
+        metrics_functions['recall']=lambda : self._macro(tp,label_count)
+        metrics_functions['precision']=lambda : self._macro(tp,pred_count)
+        metrics_functions['auroc']=self.auroc
+        return {name:metrics_functions[name]() for name in self.metrics_name}
+
+    def all_reduce(self):
+        # merge confusion matrix/histograms of every process
+        self._grow(int(all_reduce_array(np.array([len(self.confusion_matrix)]),'max')[0]))
+        self.confusion_matrix=all_reduce_array(self.confusion_matrix,'sum')
+        self.pos_hist=all_reduce_array(self.pos_hist,'sum')
+        self.neg_hist=all_reduce_array(self.neg_hist,'sum')
+
 
 def init_weights(net, init_type='normal', gain=0.02):
     def init_func(m):
@@ -52,23 +151,37 @@ def init_weights(net, init_type='normal', gain=0.02):
     #print('initialize network with %s' % init_type)
     net.apply(init_func)
 
-def move_to(obj,**kwargs):
-    if torch.is_tensor(obj):
-        return obj.to(**kwargs)
-    elif isinstance(obj, dict):
-        res = {}
-        for k, v in obj.items():
-            res[k] = move_to(v, **kwargs)
-        return res
-    elif isinstance(obj, list):
-        res = []
-        for v in obj:
-            res.append(move_to(v, **kwargs))
-        return res
-
 class Recorder(dict):
+    '''
+    running=True keep count/sum/sum of squares/min/max of scalar values in an array,
+    get_avg/get_stats are O(1) per key. keep_values=False skip storing scalar values in lists.
+    '''
+    stats_columns=['count','sum','sumsq','min','max']
+
+    def __init__(self,running=False,keep_values=True):
+        super().__init__()
+        self.running=running
+        self.keep_values=keep_values
+        self.stats_index={}
+        self.stats=np.zeros((0,len(Recorder.stats_columns)),dtype=np.float64)
+
+    def _update_stats(self,k,v):
+        if k not in self.stats_index:
+            self.stats_index[k]=len(self.stats)
+            self.stats=np.concatenate([self.stats,[[0,0,0,np.inf,-np.inf]]])
+        row=self.stats[self.stats_index[k]]
+        row[0]+=1
+        row[1]+=v
+        row[2]+=v*v
+        row[3]=min(row[3],v)
+        row[4]=max(row[4],v)
+
     def __call__(self,**kwargs):
         for k,v in kwargs.items():
+            if self.running and np.ndim(v)==0:
+                self._update_stats(k,float(v))
+                if not self.keep_values:
+                    continue
             if k in self.keys():
                 self[k].append(v)
             else:
@@ -91,9 +204,97 @@ class Recorder(dict):
     def get_avg(self,keys):
         return_dict={}
         for k in keys:
-            return_dict[k]=np.mean(self[k])
+            if k in self.stats_index:
+                count,total=self.stats[self.stats_index[k],:2]
+                return_dict[k]=total/count
+            else:
+                return_dict[k]=np.mean(self[k])
+        return return_dict
+
+    def all_reduce(self):
+        # merge running stats of every process, keys are recorded in the same order
+        self.stats[:,:3]=all_reduce_array(self.stats[:,:3],'sum')
+        self.stats[:,3]=all_reduce_array(self.stats[:,3],'min')
+        self.stats[:,4]=all_reduce_array(self.stats[:,4],'max')
+
+    def get_stats(self,keys):
+        return_dict={}
+        for k in keys:
+            count,total,sumsq,min_value,max_value=self.stats[self.stats_index[k]]
+            mean=total/count
+            return_dict[k]={'count':int(count),
+                            'mean':mean,
+                            'std':np.sqrt(max(sumsq/count-mean*mean,0.)),
+                            'min':min_value,
+                            'max':max_value}
         return return_dict
 
+class MemmapSink():
+    '''
+    Write batches of predictions into a preallocated memory-mapped .npy file.
+    The file is created on the first write (sample shape/dtype come from the batch),
+    length=None grow the file by doubling and trim it in close(), the .npy header is rewritten
+    in place and the file resized, written predictions never go through memory.
+    close() return a lazy np.load(path,mmap_mode='r') handle.
+    '''
+    def __init__(self,path,length=None,dtype=None):
+        self.path=path
+        self.length=length
+        self.dtype=dtype
+        self.array=None
+        self.count=0
+        os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+
+    def _open(self,shape,dtype,capacity):
+        return np.lib.format.open_memmap(self.path,mode='w+',dtype=dtype,shape=(capacity,*shape))
+
+    def _resize(self,capacity):
+        # numpy pad the header so the first axis can grow without moving the data
+        shape,dtype,offset=self.array.shape[1:],self.array.dtype,self.array.offset
+        self.array.flush()
+        self.array=None
+        with open(self.path,'r+b') as f:
+            version=np.lib.format.read_magic(f)
+            header={'descr':np.lib.format.dtype_to_descr(dtype),'fortran_order':False,'shape':(capacity,*shape)}
+            f.seek(0)
+            if version == (1,0):
+                np.lib.format.write_array_header_1_0(f,header)
+            else:
+                np.lib.format.write_array_header_2_0(f,header)
+            if f.tell() != offset:
+                raise Exception(f'{self.path} header size changed, can not resize in place.')
+            f.truncate(offset+capacity*int(np.prod(shape))*dtype.itemsize)
+        return np.load(self.path,mmap_mode='r+')
+
+    def _grow(self,capacity):
+        self.array=self._resize(capacity)
+
+    def write(self,batch):
+        if torch.is_tensor(batch):
+            batch=batch.detach().cpu().numpy()
+        batch=np.asarray(batch,dtype=self.dtype)
+        if self.array is None:
+            self.array=self._open(batch.shape[1:],batch.dtype,self.length if self.length else max(len(batch),1024))
+        if self.count+len(batch) > len(self.array):
+            if self.length:
+                raise Exception(f'{self.path} preallocated {self.length} samples, got {self.count+len(batch)}.')
+            self._grow(max(2*len(self.array),self.count+len(batch)))
+        self.array[self.count:self.count+len(batch)]=batch
+        self.count+=len(batch)
+
+    def close(self):
+        if self.array is None:
+            return None
+        if self.count < len(self.array):
+            if self.length:
+                print(f'{self.path} preallocated {self.length} samples, only {self.count} written.')
+            self._resize(self.count)
+        else:
+            self.array.flush()
+            del self.array
+        self.array=None
+        return np.load(self.path,mmap_mode='r')
+
 class Model_Instance():
     def __init__(self,
                  model,
@@ -101,13 +302,27 @@ class Model_Instance():
                  scheduler=None,
                  scheduler_iter=False,
                  loss_function=None,
-                 evaluation_function=lambda x,y : {},
+                 evaluation_function=None,
                  clip_grad=None,
                  device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"),
                  save_dir ='checkpoint',
                  amp=False,
+                 amp_dtype=None,
                  accum_iter=1,
-                 model_weight_init=None):
+                 model_weight_init=None,
+                 keep_outputs=False,
+                 sync_interval=1,
+                 refresh_interval=1,
+                 batch_transform=None,
+                 prefetch=2,
+                 transfer_policy=None,
+                 distributed=False,
+                 micro_batch_size=None,
+                 micro_batch_memory=None,
+                 compile_mode=None,
+                 compile_loss=False,
+                 compile_options=None,
+                 compile_cache_dir='compile_cache'):
         self.model = model.to(device)
         self.model_weight_init=model_weight_init
         self.save_dir = save_dir
@@ -117,110 +332,334 @@ class Model_Instance():
         self.loss_criterial = loss_function
         self.clip_grad = clip_grad
         self.evaluation_fn=evaluation_function
+        # metrics names are computed incrementally by StreamingMetrics, custom function need raw outputs
+        self.metrics_name=None
         if isinstance(self.evaluation_fn,list):
-            self.evaluation_fn=calculate_metrics(self.evaluation_fn)
+            if not set(self.evaluation_fn).issubset(set(StreamingMetrics.support_metrics)):
+                raise Exception(f'{set(self.evaluation_fn) - set(StreamingMetrics.support_metrics)} metrics not support')
+            self.metrics_name=self.evaluation_fn
+            self.evaluation_fn=None
+        self.keep_outputs=keep_outputs
+        # materialize losses/predictions on host every sync_interval steps
+        self.sync_interval=max(int(sync_interval),1)
+        # rebuild progress bar postfix every refresh_interval steps
+        self.refresh_interval=max(int(refresh_interval),1)
+        # batched augmentation on device, see augmentation.py
+        self.batch_transform=batch_transform
+        # number of batches staged on device ahead of the current step, 0 disable
+        self.prefetch=prefetch
+        # dtype rules of data/label when moving to device, see utils.TransferPolicy
+        self.transfer_policy=transfer_policy if transfer_policy else TransferPolicy()
         self.device = device
+        # precision policy: amp autocast bfloat16 on CPU, float16 with loss scaling on CUDA
         self.amp=amp
+        self.device_type=torch.device(device).type
+        self.amp_dtype=amp_dtype if amp_dtype else (torch.float16 if self.device_type == 'cuda' else torch.bfloat16)
         self.accum_iter=accum_iter
+        # micro-batches accumulated since the last optimizer step
+        self.accum_count=0
+        # split every training batch in chunks of micro_batch_size, 'auto' halve the chunk on out of memory
+        self.micro_batch_size=micro_batch_size
+        # 'auto' with a budget (MB of activations saved for backward per chunk) size chunks from measured memory
+        self.micro_batch_memory=micro_batch_memory
+        self.auto_micro_batch_size=None
+        # largest chunk that fit after an out of memory, cap the budget sizing
+        self.micro_batch_limit=None
         self.run_iter=1
-        self.grad_scaler=GradScaler(self.amp)
-        if not os.path.exists(self.save_dir):
-            os.mkdir(self.save_dir)
+        # largest batch size that fit in memory found by predict(auto_batch_size=True)
+        self.predict_batch_size=None
+        self.grad_scaler=GradScaler(self.device_type,enabled=self.amp and self.amp_dtype == torch.float16)
+        os.makedirs(self.save_dir,exist_ok=True)
         if self.model_weight_init:
             if self.model_weight_init not in ['normal','xavier','kaiming','orthogonal']:
                 print('use normal weight init.')
                 self.model_weight_init='normal'
             init_weights(self.model,init_type=self.model_weight_init)
+        # DistributedDataParallel wrapper used for training forward, self.model stay the plain module
+        self.distributed=distributed
+        self.parallel_model=None
+        self.sharded_loaders={}
+        if self.distributed:
+            init_distributed()
+            self.parallel_model=DistributedDataParallel(self.model,device_ids=[device] if torch.device(device).type == 'cuda' else None)
+        # compile_mode 'inductor'/'script', fall back to eager when compilation fails
+        if compile_mode and compile_mode not in compile_modes:
+            raise NotImplementedError(f'{compile_mode} compile mode not support, use inductor or script')
+        self.compile_mode=compile_mode
+        self.compiled_model=None
+        if self.compile_mode:
+            self.compiled_model=CompiledModule(self.parallel_model if self.parallel_model is not None else self.model,
+                                               compile_mode,compile_options,compile_cache_dir)
+            if compile_loss and self.loss_criterial is not None:
+                self.loss_criterial=CompiledModule(self.loss_criterial,compile_mode,compile_options,compile_cache_dir)
 
     def loss_fn(self,pred,label):
+        # loss_dict values stay on device, run_model/run_dataloader decide when to sync
         loss_return = self.loss_criterial(pred,label)
         if not isinstance(loss_return,tuple):
-            loss_return = (loss_return,{'loss':loss_return.detach().to(torch.device('cpu'))})
+            loss_return = (loss_return,{'loss':loss_return.detach()})
         else:
             loss,loss_dict=loss_return
 
             # display in console
             if 'loss' not in loss_dict.keys():
                 loss_dict['loss'] = loss
-            loss_dict = {k:loss_dict[k].detach().to(torch.device('cpu').item()) for k in loss_dict.keys()}
+            loss_dict = {k:loss_dict[k].detach() for k in loss_dict.keys()}
             loss_return=(loss,loss_dict)
         return loss_return
 
     def model_update(self,loss):
-        # amp enable check
-        if self.amp and self.device != torch.device('cpu'):
-            self.grad_scaler.scale(loss/self.accum_iter).backward()
-
-            # accumulate gradient
-            if self.run_iter % self.accum_iter == 0:
-                if self.clip_grad:
-                    self.grad_scaler.unscale_(self.optimizer)
-                    torch.nn.utils.clip_grad_value_(self.model.parameters(), clip_value=self.clip_grad)
-                self.grad_scaler.step(self.optimizer)
-                self.grad_scaler.update()
-                self.optimizer.zero_grad(set_to_none=True)
+        # backward only, optimizer_step apply the accumulated gradients
+        if self.grad_scaler.is_enabled():
+            self.grad_scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+    def optimizer_step(self,all_reduce=False):
+        # gradients are summed losses/accum_iter, rescale when fewer micro-batches were accumulated
+        if self.accum_count == 0:
+            return
+        parameters = [p for p in self.model.parameters() if p.grad is not None]
+        if all_reduce and self.parallel_model is not None:
+            # last backward ran inside no_sync
+            for p in parameters:
+                p.grad.copy_(torch.from_numpy(all_reduce_array(p.grad.cpu().numpy(),'sum')).to(p.grad.device)/get_world_size())
+        if self.accum_count != self.accum_iter:
+            for p in parameters:
+                p.grad.mul_(self.accum_iter/self.accum_count)
+        if self.grad_scaler.is_enabled():
+            if self.clip_grad:
+                self.grad_scaler.unscale_(self.optimizer)
+                torch.nn.utils.clip_grad_value_(self.model.parameters(), clip_value=self.clip_grad)
+            self.grad_scaler.step(self.optimizer)
+            self.grad_scaler.update()
         else:
-            # accumulate gradient
-            (loss/self.accum_iter).backward()
-            if self.run_iter % self.accum_iter == 0:
-                if self.clip_grad:
-                    torch.nn.utils.clip_grad_value_(self.model.parameters(), clip_value=self.clip_grad)
-                self.optimizer.step()
-                self.optimizer.zero_grad(set_to_none=True)
+            if self.clip_grad:
+                torch.nn.utils.clip_grad_value_(self.model.parameters(), clip_value=self.clip_grad)
+            self.optimizer.step()
+        self.optimizer.zero_grad(set_to_none=True)
+        # per-iteration scheduler follow optimizer steps
+        if self.scheduler and self.scheduler_iter:
+            self.scheduler.step()
+        self.accum_count=0
+
+    def _apply_batch_transform(self,data,label=None,train=False):
+        if not self.batch_transform:
+            return data,label
+        if hasattr(self.batch_transform,'train'):
+            self.batch_transform.train(train)
+        return self.batch_transform(data,label)
+
+    def _autocast(self):
+        return autocast(device_type=self.device_type,dtype=self.amp_dtype,enabled=self.amp)
+
+    def _forward_model(self):
+        if self.compiled_model is not None:
+            return self.compiled_model
+        return self.parallel_model if self.parallel_model is not None else self.model
 
     def _run(self,data):
-        data = move_to(data,device=self.device,non_blocking=True,dtype=torch.float)
-        return self.model(data)
-
-    def _run_model(self,data,label):
-        pred = self._run(data)
-
-        label= move_to(label,device=self.device,non_blocking=True,dtype=torch.long)
-
-        loss_return=self.loss_fn(pred,label)
-        return pred, loss_return
-
-    def run_model(self,data,label,update=True):
+        data = self.transfer_policy(data,self.device,labeled=False)
+        data,_ = self._apply_batch_transform(data)
+        with self._autocast():
+            pred = (self.compiled_model if self.compiled_model is not None else self.model)(data)
+        return to_float(pred)
+
+    def _run_model(self,data,label,update=False):
+        data,label = self.transfer_policy((data,label),self.device)
+        data,label = self._apply_batch_transform(data,label,train=update)
+        with self._autocast():
+            pred = self._forward_model()(data)
+            loss_return=self.loss_fn(pred,label)
+        # masks may be flipped/cropped, metrics need the transformed label
+        return pred, loss_return, label.detach() if torch.is_tensor(label) else label
+
+    def _save_grads(self):
+        # parameters without gradient yet cost nothing to save
+        return [(p,None if p.grad is None else p.grad.clone()) for p in self.model.parameters()]
+
+    def _restore_grads(self,grads):
+        for p,grad in grads:
+            p.grad = grad
+
+    def _micro_batch_size(self,size):
+        if self.micro_batch_size == 'auto':
+            return min(self.auto_micro_batch_size or size,size)
+        return min(self.micro_batch_size or size,size)
+
+    def _accumulate(self,data,label,sync_grad=True):
+        # forward/backward in micro-batches, every chunk loss weighted by its share of the batch
+        size = batch_length(data) or 1
+        micro_size = self._micro_batch_size(size)
+        budget = self.micro_batch_memory*1024**2 if self.micro_batch_size == 'auto' and self.micro_batch_memory else None
+        if budget and self.auto_micro_batch_size is None:
+            # small probe chunk measure activation memory per sample
+            micro_size = min(size,2)
+        outputs = []
+        start = 0
+        while start < size:
+            end = min(start+micro_size,size)
+            chunk_data,chunk_label = (data,label) if micro_size >= size else (split_batch(data,start,end),split_batch(label,start,end))
+            # DistributedDataParallel all-reduce only on the backward before an optimizer step
+            no_sync = self.parallel_model is not None and not (sync_grad and end == size)
+            meter = SavedTensorMemory() if budget else nullcontext()
+            # a backward interrupted by out of memory already added part of the chunk gradient
+            grads = self._save_grads() if self.micro_batch_size == 'auto' else None
+            backward = False
+            try:
+                with self.parallel_model.no_sync() if no_sync else nullcontext(), meter:
+                    pred, (loss,loss_dict), chunk_label = self._run_model(chunk_data,chunk_label,update=True)
+                    backward = True
+                    self.model_update(loss*((end-start)/size/self.accum_iter))
+            except RuntimeError as e:
+                if self.micro_batch_size != 'auto' or not is_out_of_memory(e) or micro_size == 1:
+                    raise
+                # DistributedDataParallel reducer can not be rerun after a partial synced backward
+                if backward and self.parallel_model is not None and not no_sync:
+                    raise
+                if backward:
+                    self._restore_grads(grads)
+                micro_size = max(micro_size//2,1)
+                self.auto_micro_batch_size = micro_size
+                self.micro_batch_limit = micro_size
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                continue
+            if budget:
+                micro_size = max(int(budget*(end-start)/max(meter.bytes,1)),1)
+                if self.micro_batch_limit:
+                    micro_size = min(micro_size,self.micro_batch_limit)
+                self.auto_micro_batch_size = micro_size
+            outputs.append((pred.detach(),loss.detach(),loss_dict,chunk_label,(end-start)/size))
+            start = end
+        if len(outputs) == 1:
+            pred,loss,loss_dict,label,_ = outputs[0]
+            return pred,(loss,loss_dict),label
+        loss = sum(o[1]*o[4] for o in outputs)
+        loss_dict = {k:sum(o[2][k]*o[4] for o in outputs) for k in outputs[0][2].keys()}
+        return concat_batches([o[0] for o in outputs]),(loss,loss_dict),concat_batches([o[3] for o in outputs])
+
+    def run_model(self,data,label,update=True,sync=True,step=None,return_label=False):
+        # step=None step the optimizer every accum_iter calls, True/False force it
+        # return_label=True also return the label after batch_transform (flipped/cropped masks)
         self.model.train(update)
-        amp_enable=self.amp and update
-
-        # amp enable check
-        with autocast(device_type='cuda' if self.device != 'cpu' else 'cpu', dtype=torch.float16,enabled=amp_enable):
-            if update:
-                    pred, (loss,loss_dict) = self._run_model(data,label)
-                    self.model_update(loss)
-            else:
-                with torch.no_grad():
-                    pred, (loss,loss_dict) = self._run_model(data,label)
-
-        pred=pred.detach().to(torch.device('cpu'))
-        loss=loss.detach().to(torch.device('cpu')).item()
 
+        # autocast only wrap forward and loss, see _run_model
+        if update:
+            self.accum_count+=1
+            if step is None:
+                step = self.accum_count >= self.accum_iter
+            pred, (loss,loss_dict), label = self._accumulate(data,label,sync_grad=step)
+            if step:
+                self.optimizer_step()
+        else:
+            with torch.no_grad():
+                pred, (loss,loss_dict), label = self._run_model(data,label)
+
+        # half precision outputs are returned as float32
+        pred=to_float(pred.detach())
+        loss=loss.detach().float()
+        if not sync:
+            # asynchronous device->host copy, wait in _sync
+            if pred.device.type == 'cuda':
+                pred = pred.to(torch.device('cpu'),non_blocking=True)
+            return (pred, (loss,loss_dict), label) if return_label else (pred, (loss,loss_dict))
+
+        pred=pred.to(torch.device('cpu'))
+        loss=loss.to(torch.device('cpu')).item()
+        loss_dict={k:v.to(torch.device('cpu')).item() for k,v in loss_dict.items()}
+        if return_label:
+            return pred, (loss,loss_dict), map_tensors(label,lambda t: t.to(torch.device('cpu')))
         return  pred, (loss,loss_dict)
 
-
-    def run_dataloader(self,dataloader,logger=None,update=True):
-        recorder = Recorder()
+    def _sync(self,pending):
+        # one device->host transfer for all losses of pending steps
+        if len(pending)==0:
+            return []
+        if torch.device(self.device).type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        keys = list(pending[0][1].keys())
+        losses = torch.stack([loss_dict[k].float() for _,loss_dict,_ in pending for k in keys]).cpu().view(len(pending),len(keys)).tolist()
+        return [(pred,dict(zip(keys,loss_values)),label.cpu() if torch.is_tensor(label) else label)
+                for (pred,_,label),loss_values in zip(pending,losses)]
+
+    def _record_outputs(self,pending,recorder,metrics,keep_outputs):
+        for pred,loss_dict,label in self._sync(pending):
+            if metrics:
+                metrics.update(pred,label)
+            if keep_outputs:
+                recorder(pred=pred,label=label)
+            recorder(**loss_dict)
+
+    def _prefetch(self,dataloader,labeled=True):
+        if not self.prefetch:
+            return dataloader
+        return DevicePrefetcher(dataloader,self.device,depth=self.prefetch,
+                                transfer=lambda batch: self.transfer_policy(batch,self.device,labeled=labeled))
+
+    def _shard(self,dataloader):
+        # DistributedSampler version of dataloader, set_epoch reshuffle every call
+        key=id(dataloader)
+        if key not in self.sharded_loaders or self.sharded_loaders[key][0] is not dataloader:
+            self.sharded_loaders[key]=[dataloader,distributed_dataloader(dataloader),0]
+        entry=self.sharded_loaders[key]
+        if hasattr(entry[1].sampler,'set_epoch'):
+            entry[1].sampler.set_epoch(entry[2])
+        entry[2]+=1
+        return entry[1]
+
+    def run_dataloader(self,dataloader,logger=None,update=True,keep_outputs=None):
+        if keep_outputs is None:
+            keep_outputs=self.keep_outputs
+        # custom evaluation function always need raw outputs
+        keep_outputs = keep_outputs or self.evaluation_fn is not None
+        metrics = StreamingMetrics(self.metrics_name) if self.metrics_name else None
+        # per-step losses are kept (scalars), pred/label only with keep_outputs
+        recorder = Recorder(running=True)
+        pending = []
+        last_refresh = 0
         self.run_iter=0
-        trange = tqdm(dataloader,total=len(dataloader),desc=logger.tag if logger else '',bar_format='{desc:<5.5} {percentage:3.0f}%|{bar:20}{r_bar}')
+        if self.distributed:
+            dataloader=self._shard(dataloader)
+        trange = tqdm(dataloader,total=len(dataloader),desc=logger.tag if logger else '',bar_format='{desc:<5.5} {percentage:3.0f}%|{bar:20}{r_bar}',disable=not is_main_process())
 
-        for data,label in dataloader :
+        n_batches = len(dataloader) if hasattr(dataloader,'__len__') else None
+        for data,label in self._prefetch(dataloader) :
             self.run_iter+=1
 
-            pred,(loss,loss_dict) = self.run_model(data,label,update=update)
-
-            if self.scheduler and self.scheduler_iter and update:
-                self.scheduler.step()
-
-            recorder(pred=pred,label=label,**loss_dict)
-            trange.set_postfix(**recorder.get_avg(loss_dict.keys()))
+            # last batch flush the trailing partial accumulation
+            step = True if update and self.run_iter == n_batches else None
+            pred,(loss,loss_dict),label = self.run_model(data,label,update=update,sync=False,step=step,return_label=True)
+            pending.append((pred,loss_dict,label))
+
+            if len(pending) >= self.sync_interval:
+                self._record_outputs(pending,recorder,metrics,keep_outputs)
+                pending = []
+            if self.run_iter-last_refresh >= self.refresh_interval and recorder.stats_index:
+                last_refresh = self.run_iter
+                trange.set_postfix(**recorder.get_avg(recorder.stats_index.keys()),refresh=False)
             trange.update()
+        if update and self.accum_count:
+            self.optimizer_step(all_reduce=True)
+        self._record_outputs(pending,recorder,metrics,keep_outputs)
+        if self.distributed:
+            recorder.all_reduce()
+            if metrics:
+                metrics.all_reduce()
+            for k in ['pred','label']:
+                if k in recorder:
+                    recorder[k]=[v for values in all_gather_object(recorder[k]) for v in values]
 
         outcome=recorder.get_dict(concat=['pred','label'])
-        evaluate_dict = self.evaluation_fn(outcome['pred'],outcome['label'])
-        avg_loss_dict=recorder.get_avg(loss_dict.keys())
+        if metrics:
+            evaluate_dict = metrics.compute()
+        elif self.evaluation_fn:
+            evaluate_dict = self.evaluation_fn(outcome['pred'],outcome['label'])
+        else:
+            evaluate_dict = {}
+        avg_loss_dict=recorder.get_avg(recorder.stats_index.keys())
         record_dict={**evaluate_dict,**avg_loss_dict}
-        if logger:
+        if logger and is_main_process():
             logger(**record_dict)
         trange.set_postfix(**record_dict)
         return outcome,record_dict
@@ -230,36 +669,172 @@ class Model_Instance():
         self.model.train(False)
         return self._run(data).to(torch.device('cpu'))
 
-    def inferance_dataloader(self,dataloader):
+    def _predict_batch(self,samples,collate_fn,batcher=None):
+        # batcher is given when auto_batch_size, out of memory halve its max_batch_size and retry
+        outputs = []
+        start = 0
+        while start < len(samples):
+            chunk = samples[start:start+batcher.max_batch_size] if batcher else samples
+            try:
+                pred = self.inference(collate_fn(chunk))
+            except RuntimeError as e:
+                if batcher is None or not is_out_of_memory(e) or len(chunk) == 1:
+                    raise
+                batcher.max_batch_size = max(len(chunk)//2,1)
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                continue
+            outputs.extend(pred.unbind(0) if torch.is_tensor(pred) else
+                           [map_tensors(pred,lambda t: t[i]) for i in range(len(chunk))])
+            start += len(chunk)
+        return outputs
+
+    def predict(self,samples,max_batch_size=32,max_latency=0.01,bucket=False,auto_batch_size=False,collate_fn=None):
+        '''
+        Serving style inference over an iterable/stream of single samples (without batch dimension).
+        Samples are batched up to max_batch_size or whatever arrived within max_latency seconds,
+        bucket=True only batch samples with the same input shapes (or give a function sample->key).
+        auto_batch_size=True halve the batch size on out of memory and keep the largest size that fit.
+        Yield predictions one by one in input order.
+        '''
+        collate_fn = collate_fn if collate_fn else default_collate
+        if auto_batch_size and self.predict_batch_size:
+            max_batch_size = min(max_batch_size,self.predict_batch_size)
+        batcher = DynamicBatcher(samples,max_batch_size,max_latency,bucket)
+        results = {}
+        next_index = 0
+        for items in batcher:
+            preds = self._predict_batch([sample for _,sample in items],collate_fn,batcher if auto_batch_size else None)
+            results.update(zip([index for index,_ in items],preds))
+            while next_index in results:
+                yield results.pop(next_index)
+                next_index += 1
+        if auto_batch_size:
+            self.predict_batch_size = batcher.max_batch_size
+
+    def _compress_pred(self,pred,compress=None,threshold=0.5):
+        # run on device, before the device->host copy
+        if compress is None:
+            return pred
+        if compress == 'float16':
+            return pred.half()
+        if compress == 'argmax':
+            return pred.argmax(1).to(torch.uint8 if pred.shape[1] <= 256 else torch.int64)
+        if compress == 'threshold':
+            return (pred >= threshold).to(torch.uint8)
+        raise Exception(f'{compress} compress not support, use float16/argmax/threshold')
+
+    def inferance_dataloader(self,dataloader,output_path=None,compress=None,threshold=0.5):
+        '''
+        output_path='preds.npy' write predictions batch by batch into a preallocated memory-mapped .npy
+        and return {'pred':np.load(output_path,mmap_mode='r')} instead of an in-RAM array.
+        compress: None, 'float16', 'argmax' (class index on dim 1) or 'threshold' (pred>=threshold as uint8).
+        '''
+        length = len(dataloader.dataset) if hasattr(dataloader,'dataset') and hasattr(dataloader.dataset,'__len__') else None
+        sink = MemmapSink(output_path,length) if output_path else None
         reocord = Recorder()
+        self.model.train(False)
         trange = tqdm(dataloader,total=len(dataloader))
-        for data in dataloader :
-            pred= self.inference(data)
-            reocord(pred=pred)
+        for data in self._prefetch(dataloader,labeled=False) :
+            with torch.no_grad():
+                pred = self._compress_pred(self._run(data),compress,threshold).to(torch.device('cpu'))
+            if sink:
+                sink.write(pred)
+            else:
+                reocord(pred=pred)
             trange.update()
+        if sink:
+            return {'pred':sink.close()}
         return reocord.get_dict(concat=['pred'])
 
-    def save(self,only_model=True,filename='model_checkpoint.pkl'):
+    def save(self,only_model=True,filename='model_checkpoint.pkl',loggers=[]):
+        # only_model=False save the full training state, see checkpoint.Checkpointer for async saving
+        if not is_main_process():
+            return
         save_path = os.path.join(self.save_dir,filename)
         if only_model:
-            torch.save(self.model.state_dict(),save_path)
+            atomic_save(self.model.state_dict(),save_path)
         else:
-            #save model instance
-            pass
-    #TODO
-    def load(self,only_model=True,filename='model_checkpoint.pkl'):
+            atomic_save(training_state(self,loggers),save_path)
+
+    def load(self,only_model=True,filename='model_checkpoint.pkl',loggers=[],strict=True):
+        # memory-mapped, tensors go straight to self.device, return missing/unexpected/mismatched keys
         path = os.path.join(self.save_dir,filename)
-        self.model.load_state_dict(torch.load(path))
+        if only_model:
+            return load_model_state(self.model,load_file(path,self.device),strict)
+        return load_training_state(self,load_file(path,self.device,weights_only=False),loggers,strict)['report']
 
 
 class Ensemble_Instance():
+    '''
+    Stacking ensemble of Model_Instance members.
+    run_dataloader feed every batch to all members once and cache member predictions
+    in cache_dir/name/member{i}.npy (memory-mapped), fit/predict train and apply the
+    ensemble_model on cached arrays, so refitting never rerun the networks.
+    output_function is applied to member outputs before caching, e.g. lambda x: x.softmax(1).
+    '''
     def __init__(self,
                  ensemble_model=LogisticRegression,
                  model_list=[],
+                 cache_dir='ensemble_cache',
+                 output_function=None,
                  ):
         self.ensemble_model = ensemble_model
         self.model_list = model_list
+        self.cache_dir = cache_dir
+        self.output_function = output_function
+        self.meta_model = None
 
-    def run_dataloader(self,dataloader):
-        pass
+    def _cache_path(self,name,filename):
+        return os.path.join(self.cache_dir,name,filename)
 
+    def load_cache(self,name):
+        with open(self._cache_path(name,'meta.json'),'r') as f:
+            meta = json.load(f)
+        cache = {'pred':[np.load(self._cache_path(name,f'member{i}.npy'),mmap_mode='r') for i in range(meta['members'])]}
+        if meta['labeled']:
+            cache['label'] = np.load(self._cache_path(name,'label.npy'),mmap_mode='r')
+        return cache
+
+    @torch.no_grad()
+    def run_dataloader(self,dataloader,name='valid',labeled=True,overwrite=False):
+        if not overwrite and os.path.exists(self._cache_path(name,'meta.json')):
+            cache = self.load_cache(name)
+            if len(cache['pred']) == len(self.model_list):
+                return cache
+        length = len(dataloader.dataset) if hasattr(dataloader,'dataset') and hasattr(dataloader.dataset,'__len__') else None
+        sinks = [MemmapSink(self._cache_path(name,f'member{i}.npy'),length) for i in range(len(self.model_list))]
+        label_sink = MemmapSink(self._cache_path(name,'label.npy'),length) if labeled else None
+        for member in self.model_list:
+            member.model.train(False)
+        # batches are staged on the first member device, other members only move them if needed
+        first = self.model_list[0]
+        for batch in tqdm(first._prefetch(dataloader,labeled=labeled),total=len(dataloader)):
+            data,label = batch if labeled else (batch,None)
+            for member,sink in zip(self.model_list,sinks):
+                pred = member._run(data).float()
+                if self.output_function:
+                    pred = self.output_function(pred)
+                sink.write(pred)
+            if labeled:
+                label_sink.write(label)
+        for sink in sinks+([label_sink] if labeled else []):
+            sink.close()
+        with open(self._cache_path(name,'meta.json'),'w') as f:
+            json.dump({'members':len(sinks),'labeled':labeled},f)
+        return self.load_cache(name)
+
+    def features(self,cache):
+        return np.concatenate([np.asarray(pred).reshape(len(pred),-1) for pred in cache['pred']],axis=1)
+
+    def fit(self,name='valid',**kwargs):
+        cache = self.load_cache(name)
+        self.meta_model = self.ensemble_model(**kwargs)
+        self.meta_model.fit(self.features(cache),np.asarray(cache['label']))
+        return self.meta_model
+
+    def predict(self,name='test',proba=True):
+        x = self.features(self.load_cache(name))
+        if proba and hasattr(self.meta_model,'predict_proba'):
+            return self.meta_model.predict_proba(x)
+        return self.meta_model.predict(x)
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import init
+from torch.utils.checkpoint import checkpoint
+from contextlib import contextmanager, nullcontext
 
 def init_weights(net, init_type='normal', gain=0.02):
     def init_func(m):
@@ -26,6 +28,38 @@ def init_weights(net, init_type='normal', gain=0.02):
     print('initialize network with %s' % init_type)
     net.apply(init_func)
 
+@contextmanager
+def frozen_bn_stats(module):
+    # recomputed forward must not update BatchNorm running stats a second time
+    norms = [m for m in module.modules() if isinstance(m,nn.modules.batchnorm._BatchNorm)]
+    saved = [(m.momentum,m.num_batches_tracked.clone() if m.num_batches_tracked is not None else None) for m in norms]
+    for m in norms:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m,(momentum,num_batches_tracked) in zip(norms,saved):
+            m.momentum = momentum
+            if num_batches_tracked is not None:
+                m.num_batches_tracked.copy_(num_batches_tracked)
+
+def checkpoint_call(module,*args,enabled=True):
+    # activation checkpointing, module activations are recomputed in backward instead of stored
+    if enabled and torch.is_grad_enabled() and any(torch.is_tensor(a) and a.requires_grad for a in args+tuple(module.parameters())):
+        return checkpoint(module,*args,use_reentrant=False,context_fn=lambda: (nullcontext(),frozen_bn_stats(module)))
+    return module(*args)
+
+def stage_call(net,name,*args):
+    # net.checkpoint_stages: True for every stage or a list of module names e.g. ['Conv1','Up_conv5']
+    stages = net.checkpoint_stages
+    return checkpoint_call(getattr(net,name),*args,enabled=stages is True or (bool(stages) and name in stages))
+
+def set_recurrent_checkpoint(net,enabled=True):
+    # checkpoint every Recurrent_block inside RRCNN_blocks
+    for m in net.modules():
+        if isinstance(m,RRCNN_block):
+            m.checkpoint = enabled
+
 class conv_block(nn.Module):
     def __init__(self,ch_in,ch_out):
         super(conv_block,self).__init__()
@@ -78,8 +112,9 @@ class Recurrent_block(nn.Module):
         return x1
 
 class RRCNN_block(nn.Module):
-    def __init__(self,ch_in,ch_out,t=2):
+    def __init__(self,ch_in,ch_out,t=2,checkpoint=False):
         super(RRCNN_block,self).__init__()
+        self.checkpoint = checkpoint
         self.RCNN = nn.Sequential(
             Recurrent_block(ch_out,t=t),
             Recurrent_block(ch_out,t=t)
@@ -88,7 +123,9 @@ class RRCNN_block(nn.Module):
 
     def forward(self,x):
         x = self.Conv_1x1(x)
-        x1 = self.RCNN(x)
+        x1 = x
+        for block in self.RCNN:
+            x1 = checkpoint_call(block,x1,enabled=self.checkpoint)
         return x+x1
 
 
@@ -136,8 +173,9 @@ class Attention_block(nn.Module):
 
 
 class U_Net(nn.Module):
-    def __init__(self,img_ch=3,output_ch=1):
+    def __init__(self,img_ch=3,output_ch=1,checkpoint_stages=None):
         super(U_Net,self).__init__()
+        self.checkpoint_stages = checkpoint_stages
 
         self.Maxpool = nn.MaxPool2d(kernel_size=2,stride=2)
 
@@ -164,37 +202,37 @@ class U_Net(nn.Module):
 
     def forward(self,x):
         # encoding path
-        x1 = self.Conv1(x)
+        x1 = stage_call(self,'Conv1',x)
 
         x2 = self.Maxpool(x1)
-        x2 = self.Conv2(x2)
+        x2 = stage_call(self,'Conv2',x2)
 
         x3 = self.Maxpool(x2)
-        x3 = self.Conv3(x3)
+        x3 = stage_call(self,'Conv3',x3)
 
         x4 = self.Maxpool(x3)
-        x4 = self.Conv4(x4)
+        x4 = stage_call(self,'Conv4',x4)
 
         x5 = self.Maxpool(x4)
-        x5 = self.Conv5(x5)
+        x5 = stage_call(self,'Conv5',x5)
 
         # decoding + concat path
-        d5 = self.Up5(x5)
+        d5 = stage_call(self,'Up5',x5)
         d5 = torch.cat((x4,d5),dim=1)
 
-        d5 = self.Up_conv5(d5)
+        d5 = stage_call(self,'Up_conv5',d5)
 
-        d4 = self.Up4(d5)
+        d4 = stage_call(self,'Up4',d5)
         d4 = torch.cat((x3,d4),dim=1)
-        d4 = self.Up_conv4(d4)
+        d4 = stage_call(self,'Up_conv4',d4)
 
-        d3 = self.Up3(d4)
+        d3 = stage_call(self,'Up3',d4)
         d3 = torch.cat((x2,d3),dim=1)
-        d3 = self.Up_conv3(d3)
+        d3 = stage_call(self,'Up_conv3',d3)
 
-        d2 = self.Up2(d3)
+        d2 = stage_call(self,'Up2',d3)
         d2 = torch.cat((x1,d2),dim=1)
-        d2 = self.Up_conv2(d2)
+        d2 = stage_call(self,'Up_conv2',d2)
 
         d1 = self.Conv_1x1(d2)
 
@@ -202,8 +240,9 @@ class U_Net(nn.Module):
 
 
 class R2U_Net(nn.Module):
-    def __init__(self,img_ch=3,output_ch=1,t=2):
+    def __init__(self,img_ch=3,output_ch=1,t=2,checkpoint_stages=None,checkpoint_recurrent=False):
         super(R2U_Net,self).__init__()
+        self.checkpoint_stages = checkpoint_stages
 
         self.Maxpool = nn.MaxPool2d(kernel_size=2,stride=2)
         self.Upsample = nn.Upsample(scale_factor=2)
@@ -232,40 +271,41 @@ class R2U_Net(nn.Module):
         self.Up_RRCNN2 = RRCNN_block(ch_in=128, ch_out=64,t=t)
 
         self.Conv_1x1 = nn.Conv2d(64,output_ch,kernel_size=1,stride=1,padding=0)
+        set_recurrent_checkpoint(self,checkpoint_recurrent)
 
 
     def forward(self,x):
         # encoding path
-        x1 = self.RRCNN1(x)
+        x1 = stage_call(self,'RRCNN1',x)
 
         x2 = self.Maxpool(x1)
-        x2 = self.RRCNN2(x2)
+        x2 = stage_call(self,'RRCNN2',x2)
 
         x3 = self.Maxpool(x2)
-        x3 = self.RRCNN3(x3)
+        x3 = stage_call(self,'RRCNN3',x3)
 
         x4 = self.Maxpool(x3)
-        x4 = self.RRCNN4(x4)
+        x4 = stage_call(self,'RRCNN4',x4)
 
         x5 = self.Maxpool(x4)
-        x5 = self.RRCNN5(x5)
+        x5 = stage_call(self,'RRCNN5',x5)
 
         # decoding + concat path
-        d5 = self.Up5(x5)
+        d5 = stage_call(self,'Up5',x5)
         d5 = torch.cat((x4,d5),dim=1)
-        d5 = self.Up_RRCNN5(d5)
+        d5 = stage_call(self,'Up_RRCNN5',d5)
 
-        d4 = self.Up4(d5)
+        d4 = stage_call(self,'Up4',d5)
         d4 = torch.cat((x3,d4),dim=1)
-        d4 = self.Up_RRCNN4(d4)
+        d4 = stage_call(self,'Up_RRCNN4',d4)
 
-        d3 = self.Up3(d4)
+        d3 = stage_call(self,'Up3',d4)
         d3 = torch.cat((x2,d3),dim=1)
-        d3 = self.Up_RRCNN3(d3)
+        d3 = stage_call(self,'Up_RRCNN3',d3)
 
-        d2 = self.Up2(d3)
+        d2 = stage_call(self,'Up2',d3)
         d2 = torch.cat((x1,d2),dim=1)
-        d2 = self.Up_RRCNN2(d2)
+        d2 = stage_call(self,'Up_RRCNN2',d2)
 
         d1 = self.Conv_1x1(d2)
 
@@ -274,8 +314,9 @@ class R2U_Net(nn.Module):
 
 
 class AttU_Net(nn.Module):
-    def __init__(self,img_ch=3,output_ch=1):
+    def __init__(self,img_ch=3,output_ch=1,checkpoint_stages=None):
         super(AttU_Net,self).__init__()
+        self.checkpoint_stages = checkpoint_stages
 
         self.Maxpool = nn.MaxPool2d(kernel_size=2,stride=2)
 
@@ -306,40 +347,40 @@ class AttU_Net(nn.Module):
 
     def forward(self,x):
         # encoding path
-        x1 = self.Conv1(x)
+        x1 = stage_call(self,'Conv1',x)
 
         x2 = self.Maxpool(x1)
-        x2 = self.Conv2(x2)
+        x2 = stage_call(self,'Conv2',x2)
 
         x3 = self.Maxpool(x2)
-        x3 = self.Conv3(x3)
+        x3 = stage_call(self,'Conv3',x3)
 
         x4 = self.Maxpool(x3)
-        x4 = self.Conv4(x4)
+        x4 = stage_call(self,'Conv4',x4)
 
         x5 = self.Maxpool(x4)
-        x5 = self.Conv5(x5)
+        x5 = stage_call(self,'Conv5',x5)
 
         # decoding + concat path
-        d5 = self.Up5(x5)
-        x4 = self.Att5(g=d5,x=x4)
+        d5 = stage_call(self,'Up5',x5)
+        x4 = stage_call(self,'Att5',d5,x4)
         d5 = torch.cat((x4,d5),dim=1)
-        d5 = self.Up_conv5(d5)
+        d5 = stage_call(self,'Up_conv5',d5)
 
-        d4 = self.Up4(d5)
-        x3 = self.Att4(g=d4,x=x3)
+        d4 = stage_call(self,'Up4',d5)
+        x3 = stage_call(self,'Att4',d4,x3)
         d4 = torch.cat((x3,d4),dim=1)
-        d4 = self.Up_conv4(d4)
+        d4 = stage_call(self,'Up_conv4',d4)
 
-        d3 = self.Up3(d4)
-        x2 = self.Att3(g=d3,x=x2)
+        d3 = stage_call(self,'Up3',d4)
+        x2 = stage_call(self,'Att3',d3,x2)
         d3 = torch.cat((x2,d3),dim=1)
-        d3 = self.Up_conv3(d3)
+        d3 = stage_call(self,'Up_conv3',d3)
 
-        d2 = self.Up2(d3)
-        x1 = self.Att2(g=d2,x=x1)
+        d2 = stage_call(self,'Up2',d3)
+        x1 = stage_call(self,'Att2',d2,x1)
         d2 = torch.cat((x1,d2),dim=1)
-        d2 = self.Up_conv2(d2)
+        d2 = stage_call(self,'Up_conv2',d2)
 
         d1 = self.Conv_1x1(d2)
 
@@ -347,8 +388,9 @@ class AttU_Net(nn.Module):
 
 
 class R2AttU_Net(nn.Module):
-    def __init__(self,img_ch=3,output_ch=1,t=2):
+    def __init__(self,img_ch=3,output_ch=1,t=2,checkpoint_stages=None,checkpoint_recurrent=False):
         super(R2AttU_Net,self).__init__()
+        self.checkpoint_stages = checkpoint_stages
         self.times=1
         self.Maxpool = nn.MaxPool2d(kernel_size=2,stride=2)
         self.Upsample = nn.Upsample(scale_factor=2)
@@ -381,44 +423,45 @@ class R2AttU_Net(nn.Module):
         self.Up_RRCNN2 = RRCNN_block(ch_in=128, ch_out=64,t=t)
 
         self.Conv_1x1 = nn.Conv2d(64,output_ch,kernel_size=1,stride=1,padding=0)
+        set_recurrent_checkpoint(self,checkpoint_recurrent)
 
 
     def forward(self,x):
         # encoding path
-        x1 = self.RRCNN1(x)
+        x1 = stage_call(self,'RRCNN1',x)
 
         x2 = self.Maxpool(x1)
-        x2 = self.RRCNN2(x2)
+        x2 = stage_call(self,'RRCNN2',x2)
 
         x3 = self.Maxpool(x2)
-        x3 = self.RRCNN3(x3)
+        x3 = stage_call(self,'RRCNN3',x3)
 
         x4 = self.Maxpool(x3)
-        x4 = self.RRCNN4(x4)
+        x4 = stage_call(self,'RRCNN4',x4)
 
         x5 = self.Maxpool(x4)
-        x5 = self.RRCNN5(x5)
+        x5 = stage_call(self,'RRCNN5',x5)
 
         # decoding + concat path
-        d5 = self.Up5(x5)
-        x4 = self.Att5(g=d5,x=x4)
+        d5 = stage_call(self,'Up5',x5)
+        x4 = stage_call(self,'Att5',d5,x4)
         d5 = torch.cat((x4,d5),dim=1)
-        d5 = self.Up_RRCNN5(d5)
+        d5 = stage_call(self,'Up_RRCNN5',d5)
 
-        d4 = self.Up4(d5)
-        x3 = self.Att4(g=d4,x=x3)
+        d4 = stage_call(self,'Up4',d5)
+        x3 = stage_call(self,'Att4',d4,x3)
         d4 = torch.cat((x3,d4),dim=1)
-        d4 = self.Up_RRCNN4(d4)
+        d4 = stage_call(self,'Up_RRCNN4',d4)
 
-        d3 = self.Up3(d4)
-        x2 = self.Att3(g=d3,x=x2)
+        d3 = stage_call(self,'Up3',d4)
+        x2 = stage_call(self,'Att3',d3,x2)
         d3 = torch.cat((x2,d3),dim=1)
-        d3 = self.Up_RRCNN3(d3)
+        d3 = stage_call(self,'Up_RRCNN3',d3)
 
-        d2 = self.Up2(d3)
-        x1 = self.Att2(g=d2,x=x1)
+        d2 = stage_call(self,'Up2',d3)
+        x1 = stage_call(self,'Att2',d2,x1)
         d2 = torch.cat((x1,d2),dim=1)
-        d2 = self.Up_RRCNN2(d2)
+        d2 = stage_call(self,'Up_RRCNN2',d2)
 
         d1 = self.Conv_1x1(d2)
 
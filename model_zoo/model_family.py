@@ -5,7 +5,7 @@ class Flatten(nn.Module):
     def __init__(self):
         super().__init__()
     def forward(self, x):
-        return x.view(x.data.size(0),-1)
+        return x.view(x.size(0),-1)
 
 
 
@@ -74,11 +74,13 @@ class HarDBlock(nn.Module):
         super().__init__()
         self.keepBase = keepBase
         self.links = []
+        self.layer_channels = [in_channels]
         layers_ = []
         self.out_channels = 0 # if upsample else in_channels
         for i in range(n_layers):
           outch, inch, link = self.get_link(i+1, in_channels, growth_rate, grmul)
           self.links.append(link)
+          self.layer_channels.append(outch)
           use_relu = residual_out
           if dwconv:
             layers_.append(CombConvLayer(inch, outch))
@@ -89,29 +91,63 @@ class HarDBlock(nn.Module):
             self.out_channels += outch
         #print("Blk out =",self.out_channels)
         self.layers = nn.ModuleList(layers_)
+        self.build_graph()
+
+    def build_graph(self):
+        # outputs kept in the block output and their channel offsets,
+        # last_use[i] is the last layer reading layers_[i] (n_layers for block outputs)
+        t = len(self.links)+1
+        self.out_index = [i for i in range(t) if (i == 0 and self.keepBase) or (i == t-1) or (i%2 == 1)]
+        self.out_offset = {}
+        offset = 0
+        for i in self.out_index:
+            self.out_offset[i] = (offset,offset+self.layer_channels[i])
+            offset += self.layer_channels[i]
+        self.buffer_channels = offset
+        self.last_use = [-1]*t
+        for layer,link in enumerate(self.links):
+            for i in link:
+                self.last_use[i] = layer
+        for i in self.out_index:
+            self.last_use[i] = t-1
+
+    def _layer_input(self, layers_, layer):
+        tin = [layers_[i] for i in self.links[layer]]
+        x = torch.cat(tin, 1) if len(tin) > 1 else tin[0]
+        # drop outputs after their last consumer
+        for i in self.links[layer]:
+            if self.last_use[i] == layer:
+                layers_[i] = None
+        return x
 
     def forward(self, x):
+        # traced graphs keep the concat, in-place writes into the buffer do not survive graph rewrites
+        if not torch.is_grad_enabled() and not torch.jit.is_tracing():
+            return self._forward_buffer(x)
         layers_ = [x]
+        for layer in range(len(self.layers)):
+            layers_.append(self.layers[layer](self._layer_input(layers_, layer)))
+        return torch.cat([layers_[i] for i in self.out_index], 1)
 
+    def _forward_buffer(self, x):
+        # no grad: outputs are written once into a preallocated block output, no final concat
+        layers_ = [x]
+        out = None
         for layer in range(len(self.layers)):
-            link = self.links[layer]
-            tin = []
-            for i in link:
-                tin.append(layers_[i])
-            if len(tin) > 1:
-                x = torch.cat(tin, 1)
-            else:
-                x = tin[0]
-            out = self.layers[layer](x)
-            layers_.append(out)
-
-        t = len(layers_)
-        out_ = []
-        for i in range(t):
-          if (i == 0 and self.keepBase) or \
-             (i == t-1) or (i%2 == 1):
-              out_.append(layers_[i])
-        out = torch.cat(out_, 1)
+            y = self.layers[layer](self._layer_input(layers_, layer))
+            if out is None:
+                dtype = torch.promote_types(x.dtype, y.dtype) if 0 in self.out_offset else y.dtype
+                memory_format = torch.channels_last if y.dim() == 4 and y.is_contiguous(memory_format=torch.channels_last) and not y.is_contiguous() else torch.contiguous_format
+                out = torch.empty((y.shape[0], self.buffer_channels, *y.shape[2:]), dtype=dtype, device=y.device, memory_format=memory_format)
+                if 0 in self.out_offset:
+                    start, end = self.out_offset[0]
+                    out[:, start:end].copy_(layers_[0])
+                    layers_[0] = out[:, start:end]
+            if layer+1 in self.out_offset:
+                start, end = self.out_offset[layer+1]
+                out[:, start:end].copy_(y)
+                y = out[:, start:end]
+            layers_.append(y)
         return out
 
 
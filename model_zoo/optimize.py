@@ -0,0 +1,94 @@
+import copy
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+# Inference rewrite of model_zoo networks (HarDNet, U_Net, R2U_Net, AttU_Net, R2AttU_Net).
+# Conv2d+BatchNorm2d pairs inside nn.Sequential (ConvLayer, DWConvLayer, conv_block, up_conv,
+# Recurrent_block, single_conv, Attention_block) are folded into one Conv2d. The frozen TorchScript
+# graph then fuse Conv+ReLU and prepack the weights for the CPU backend.
+# HarDBlock link lists and U-Net stage calls are python control flow, models are traced, not scripted.
+
+def fuse_conv_bn(model):
+    '''
+    In place, model must be in eval mode. BatchNorm2d following a Conv2d is folded into the conv
+    weight/bias and replaced by nn.Identity, Sequential indices and conv state_dict names are kept.
+    '''
+    for module in list(model.modules()):
+        if not isinstance(module,nn.Sequential):
+            continue
+        names=list(module._modules.keys())
+        for name,next_name in zip(names,names[1:]):
+            conv,norm=module._modules[name],module._modules[next_name]
+            if isinstance(conv,nn.Conv2d) and isinstance(norm,nn.BatchNorm2d) and norm.track_running_stats:
+                module._modules[name]=fuse_conv_bn_eval(conv,norm)
+                module._modules[next_name]=nn.Identity()
+    return model
+
+def fused_copy(model,channels_last=True):
+    # eval copy with Conv+BN folded, the original model is untouched
+    fused=fuse_conv_bn(copy.deepcopy(model).eval())
+    for p in fused.parameters():
+        p.requires_grad_(False)
+    return fused.to(memory_format=torch.channels_last) if channels_last else fused
+
+def to_memory_format(data,channels_last=True):
+    return data.to(memory_format=torch.channels_last) if channels_last and data.dim() == 4 else data.contiguous()
+
+def trace_frozen(model,example_input):
+    with torch.no_grad():
+        return torch.jit.freeze(torch.jit.trace(model,example_input))
+
+def check_equivalence(model,optimized,example_input,rtol=1e-3,atol=1e-4,channels_last=True):
+    '''
+    Compare optimized(example_input) with the eval output of model, raise if they differ beyond
+    rtol/atol. Return the max absolute difference.
+    '''
+    training=model.training
+    model.eval()
+    with torch.no_grad():
+        expected=model(example_input)
+        output=optimized(to_memory_format(example_input,channels_last))
+    model.train(training)
+    output=output.to_dense() if output.is_mkldnn else output
+    diff=(output.float()-expected.float()).abs().max().item()
+    if not torch.allclose(output.float(),expected.float(),rtol=rtol,atol=atol):
+        raise Exception(f'optimized model output differ from the original model, max abs diff {diff}')
+    return diff
+
+def optimize_for_inference(model,example_input,channels_last=True,freeze=True,check=True,rtol=1e-3,atol=1e-4):
+    '''
+    Return an inference copy of model: Conv+BN folded, channels_last, traced on example_input,
+    frozen and optimized by torch.jit.optimize_for_inference (Conv+ReLU fusion, prepacked weights).
+    freeze=False return the eager fused module.
+    Give inputs in channels_last too (to_memory_format), the traced graph keep example_input shapes
+    for python control flow but the batch size can change.
+    check=True run check_equivalence on example_input.
+    '''
+    optimized=fused_copy(model,channels_last)
+    if freeze:
+        optimized=torch.jit.optimize_for_inference(trace_frozen(optimized,to_memory_format(example_input,channels_last)))
+    if check:
+        check_equivalence(model,optimized,example_input,rtol,atol,channels_last)
+    return optimized
+
+def export(model,example_input,path,format='torchscript',opset_version=17):
+    '''
+    torchscript: Conv+BN folded, traced and frozen graph saved with torch.jit.save, load it with
+                 torch.jit.load (call torch.jit.optimize_for_inference after loading on CPU).
+    onnx: Conv+BN folded module exported with a dynamic batch axis, need the onnx package.
+    '''
+    fused=fused_copy(model,channels_last=False)
+    if format == 'torchscript':
+        torch.jit.save(trace_frozen(fused,example_input),path)
+    elif format == 'onnx':
+        try:
+            import onnx
+        except ImportError:
+            raise Exception('onnx export need the onnx package, pip install onnx.')
+        with torch.no_grad():
+            torch.onnx.export(fused,(example_input,),path,input_names=['input'],output_names=['output'],
+                              dynamic_axes={'input':{0:'batch'},'output':{0:'batch'}},opset_version=opset_version,dynamo=False)
+    else:
+        raise NotImplementedError(f'{format} export format not support, use torchscript or onnx')
+    return path
@@ -6,6 +6,11 @@ import random
 import numpy as np
 import pandas as pd
 import os
+import dataclasses
+import threading
+import time
+from queue import Queue, Empty, Full
+from contextlib import nullcontext
 
 
 def init_weights(net, init_type='normal', gain=0.02):
@@ -52,16 +57,353 @@ def setSeed(seed=31,tor=True,tensorf=False):
         torch.cuda.manual_seed(seed)
         #torch.backends.cudnn.deterministic = True
 
-def move_to(obj,**kwargs):
+def map_tensors(obj,fn,keyed=False,key=None):
+    # apply fn to every tensor in nested dict/list/tuple/namedtuple/dataclass
+    # keyed=True call fn(tensor,key), key is the nearest dict key
     if torch.is_tensor(obj):
-        return obj.to(**kwargs)
+        return fn(obj,key) if keyed else fn(obj)
     elif isinstance(obj, dict):
-        res = {}
-        for k, v in obj.items():
-            res[k] = move_to(v, **kwargs)
-        return res
+        return {k: map_tensors(v, fn, keyed, k) for k, v in obj.items()}
+    elif isinstance(obj, tuple) and hasattr(obj, '_fields'):
+        return type(obj)(*(map_tensors(v, fn, keyed, key) for v in obj))
+    elif isinstance(obj, tuple):
+        return tuple(map_tensors(v, fn, keyed, key) for v in obj)
     elif isinstance(obj, list):
-        res = []
-        for v in obj:
-            res.append(move_to(v, **kwargs))
-        return res
\ No newline at end of file
+        return [map_tensors(v, fn, keyed, key) for v in obj]
+    elif dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.replace(obj, **{f.name: map_tensors(getattr(obj, f.name), fn, keyed, key) for f in dataclasses.fields(obj) if f.init})
+    return obj
+
+def batch_length(obj):
+    # size of dim 0 of the first tensor in a nested batch
+    sizes = []
+    map_tensors(obj, lambda t: sizes.append(t.shape[0]) if t.dim() > 0 else None)
+    return sizes[0] if sizes else None
+
+def split_batch(obj,start,end):
+    return map_tensors(obj, lambda t: t[start:end] if t.dim() > 0 else t)
+
+def concat_batches(batches):
+    # inverse of split_batch for nested tensors
+    first = batches[0]
+    if torch.is_tensor(first):
+        return torch.cat(batches) if first.dim() > 0 else torch.stack(batches).mean(0)
+    elif isinstance(first, dict):
+        return {k: concat_batches([b[k] for b in batches]) for k in first.keys()}
+    elif isinstance(first, tuple) and hasattr(first, '_fields'):
+        return type(first)(*(concat_batches(list(v)) for v in zip(*batches)))
+    elif isinstance(first, (tuple,list)):
+        return type(first)(concat_batches(list(v)) for v in zip(*batches))
+    return first
+
+def is_out_of_memory(error):
+    # CUDA raise torch.OutOfMemoryError, the CPU allocator a RuntimeError "can't allocate memory"
+    message = str(error)
+    return isinstance(error,torch.OutOfMemoryError) or 'out of memory' in message or "can't allocate memory" in message
+
+class SavedTensorMemory():
+    '''
+    Context manager summing the bytes of activations autograd save for backward inside it
+    (parameters excluded, every tensor counted once). Estimate the training memory of a forward
+    on any device, activation checkpointing is taken into account.
+    '''
+    def __init__(self):
+        self.bytes=0
+        self.storages=set()
+        self.hooks=None
+
+    def _pack(self,tensor):
+        # parameters and their views (weight.t() of linear layers) do not grow with the batch
+        base = tensor._base if tensor._base is not None else tensor
+        if not (base.is_leaf and base.requires_grad):
+            # views of a chunk share the whole batch storage, count the viewed bytes only
+            nbytes = tensor.nelement()*tensor.element_size()
+            try:
+                key = (tensor.device,tensor.data_ptr(),nbytes)
+            except RuntimeError:
+                key = id(tensor)
+            if key not in self.storages:
+                self.storages.add(key)
+                self.bytes+=nbytes
+        return tensor
+
+    def __enter__(self):
+        self.hooks=torch.autograd.graph.saved_tensors_hooks(self._pack,lambda tensor: tensor)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self,*args):
+        self.hooks.__exit__(*args)
+
+def to_float(obj):
+    # float16/bfloat16 tensors to float32, numpy has no bfloat16
+    return map_tensors(obj, lambda t: t.float() if t.dtype in [torch.float16,torch.bfloat16] else t)
+
+def move_to(obj,**kwargs):
+    return map_tensors(obj, lambda t: t.to(**kwargs))
+
+class TransferPolicy():
+    '''
+    Declare once how batches are moved to device, shared by training and inference.
+    data/label are the rules of each role, rules={dict_key:rule} override them for dict inputs.
+    rule:
+    - torch.dtype : cast to dtype
+    - 'float'     : float16/bfloat16/float32 are kept, other dtypes cast to float_dtype
+    - None        : keep dtype
+    Tensors are copied in their own dtype (uint8 images stay uint8 during transfer) and cast on device,
+    tensors already on device with the target dtype are returned without copy.
+    '''
+    def __init__(self,data='float',label=torch.long,rules=None,float_dtype=torch.float):
+        self.roles={'data':data,'label':label}
+        self.rules=rules if rules else {}
+        self.float_dtype=float_dtype
+
+    def target_dtype(self,dtype,rule):
+        if rule is None:
+            return None
+        if rule == 'float':
+            return None if dtype in [torch.float16,torch.bfloat16,torch.float32] else self.float_dtype
+        return rule
+
+    def _transfer_tensor(self,tensor,rule,device,non_blocking):
+        tensor = tensor.to(device=device,non_blocking=non_blocking)
+        dtype = self.target_dtype(tensor.dtype,rule)
+        if dtype is not None and tensor.dtype != dtype:
+            tensor = tensor.to(dtype)
+        return tensor
+
+    def transfer(self,obj,role='data',device='cpu',non_blocking=True):
+        return map_tensors(obj, lambda t,key: self._transfer_tensor(t,self.rules.get(key,self.roles[role]),device,non_blocking), keyed=True)
+
+    def __call__(self,batch,device,labeled=True,non_blocking=True):
+        if labeled:
+            data,label = batch
+            return self.transfer(data,'data',device,non_blocking),self.transfer(label,'label',device,non_blocking)
+        return self.transfer(batch,'data',device,non_blocking)
+
+class DevicePrefetcher():
+    '''
+    Iterate dataloader on a background thread, pin memory and copy the next `depth` batches
+    to device (on a side CUDA stream) while the current step is running.
+    transfer(batch) replace the default move_to(batch,device=device,non_blocking=True).
+    '''
+    _end = object()
+
+    def __init__(self,dataloader,device,depth=2,transfer=None):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.transfer = transfer if transfer else lambda batch: move_to(batch,device=self.device,non_blocking=True)
+        self.cuda = self.device.type == 'cuda'
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _stage(self,batch,stream):
+        if self.cuda:
+            batch = map_tensors(batch, lambda t: t if t.device.type != 'cpu' or t.is_pinned() else t.pin_memory())
+        with torch.cuda.stream(stream) if stream is not None else nullcontext():
+            batch = self.transfer(batch)
+            event = None
+            if stream is not None:
+                event = torch.cuda.Event()
+                event.record(stream)
+        return batch,event
+
+    def __iter__(self):
+        queue = Queue(maxsize=self.depth)
+        stop = threading.Event()
+        stream = torch.cuda.Stream(self.device) if self.cuda else None
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item,timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def worker():
+            try:
+                for batch in self.dataloader:
+                    if not put(self._stage(batch,stream)):
+                        return
+                put(DevicePrefetcher._end)
+            except BaseException as e:
+                put(e)
+
+        thread = threading.Thread(target=worker,daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is DevicePrefetcher._end:
+                    break
+                if isinstance(item,BaseException):
+                    raise item
+                batch,event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    map_tensors(batch, lambda t: t.record_stream(current_stream) if t.is_cuda else None)
+                yield batch
+        finally:
+            stop.set()
+            while True:
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    break
+            thread.join()
+
+class DynamicBatcher():
+    '''
+    Group a stream of single samples into batches for serving style inference.
+    samples are read on a background thread, a batch is yielded when it reach max_batch_size
+    or when its first sample waited max_latency seconds.
+    bucket=True keep one pending batch per input shape (no padding), bucket can also be
+    a function sample->key. Yield lists of (index,sample), index is the position in the stream.
+    max_batch_size can be lowered while iterating.
+    '''
+    _end = object()
+
+    def __init__(self,samples,max_batch_size=32,max_latency=0.01,bucket=False,queue_size=None):
+        self.samples = samples
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.bucket = bucket
+        self.queue_size = queue_size if queue_size else 4*max_batch_size
+
+    def bucket_key(self,sample):
+        if callable(self.bucket):
+            return self.bucket(sample)
+        if isinstance(sample,np.ndarray):
+            return sample.shape
+        shapes = []
+        map_tensors(sample, lambda t: shapes.append(tuple(t.shape)))
+        return tuple(shapes)
+
+    def __iter__(self):
+        queue = Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item,timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def worker():
+            try:
+                for item in enumerate(self.samples):
+                    if not put(item):
+                        return
+                put(DynamicBatcher._end)
+            except BaseException as e:
+                put(e)
+
+        thread = threading.Thread(target=worker,daemon=True)
+        thread.start()
+        # key -> (deadline,[(index,sample)]), ordered by first arrival
+        pending = {}
+        finished = False
+        try:
+            while not finished:
+                timeout = max(min(deadline for deadline,_ in pending.values())-time.perf_counter(),0) if pending else None
+                try:
+                    item = queue.get(timeout=timeout)
+                except Empty:
+                    item = None
+                if item is DynamicBatcher._end:
+                    finished = True
+                elif isinstance(item,BaseException):
+                    raise item
+                elif item is not None:
+                    key = self.bucket_key(item[1]) if self.bucket else None
+                    if key not in pending:
+                        pending[key] = (time.perf_counter()+self.max_latency,[])
+                    pending[key][1].append(item)
+                    if len(pending[key][1]) >= self.max_batch_size:
+                        yield pending.pop(key)[1]
+                now = time.perf_counter()
+                for key in [key for key,(deadline,_) in pending.items() if finished or deadline <= now]:
+                    yield pending.pop(key)[1]
+        finally:
+            stop.set()
+            while True:
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    break
+            thread.join()
+
+compile_modes=['inductor','script']
+
+def set_compile_cache_dir(cache_dir):
+    '''
+    Inductor kernels/FX graphs cache is process wide (TORCHINDUCTOR_CACHE_DIR, set by inductor itself on
+    its first compilation), the first directory stay active and a different one print which is used.
+    Return the active directory.
+    '''
+    cache_dir = os.path.abspath(cache_dir)
+    active = os.environ.get('TORCHINDUCTOR_CACHE_DIR')
+    if active is None:
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = active = cache_dir
+    elif os.path.abspath(active) != cache_dir:
+        print(f'inductor cache directory is process wide, {active} is already active, {cache_dir} is not used.')
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+    return active
+
+def compile_module(module,mode='inductor',options=None,cache_dir=None):
+    '''
+    mode: 'inductor' (torch.compile, options are given to it, e.g. {'mode':'max-autotune'})
+          or 'script' (torch.jit.script).
+    cache_dir keep inductor kernels and FX graphs between runs, later runs skip most of the warm up
+    (process wide, see set_compile_cache_dir).
+    '''
+    if mode == 'inductor':
+        if cache_dir:
+            set_compile_cache_dir(cache_dir)
+        return torch.compile(module,**(options if options else {}))
+    if mode == 'script':
+        return torch.jit.script(module)
+    raise NotImplementedError(f'{mode} compile mode not support, use inductor or script')
+
+class CompiledModule():
+    '''
+    Call the compiled version of module, if compilation fails (at compile time or on the first
+    calls, torch.compile compile lazily) print the error and fall back to the eager module.
+    Attributes are read from the eager module.
+    '''
+    def __init__(self,module,mode='inductor',options=None,cache_dir=None):
+        if mode not in compile_modes:
+            raise NotImplementedError(f'{mode} compile mode not support, use inductor or script')
+        self.module=module
+        self.mode=mode
+        self.compiled=None
+        try:
+            self.compiled=compile_module(module,mode,options,cache_dir)
+        except Exception as e:
+            self._fallback(e)
+
+    def _fallback(self,error):
+        print(f'{self.mode} compile of {getattr(self.module,"__name__",type(self.module).__name__)} failed, fall back to eager. {type(error).__name__}: {error}')
+        self.compiled=None
+
+    def __call__(self,*args,**kwargs):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args,**kwargs)
+            except Exception as e:
+                if is_out_of_memory(e):
+                    raise
+                self._fallback(e)
+        return self.module(*args,**kwargs)
+
+    def __getattr__(self,name):
+        return getattr(self.__dict__['module'],name)